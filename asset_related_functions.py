@@ -0,0 +1,141 @@
+"""Fingerprinted static assets built by static_assets.py, vendored libraries and response compression."""
+import gzip
+import logging
+import mimetypes
+import os
+import re
+
+from flask import request, send_from_directory, url_for, abort, render_template
+from markupsafe import Markup
+
+from db_app import app
+from static_assets import build, brotli, subresource_integrity, DIST_FOLDER, VENDOR
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+UUID_FILE_NAME = re.compile(r"(^|/)[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}-[^/]+$")
+COMPRESS_MIMETYPES = {"text/html", "application/json"}
+
+_manifest = {}
+_fragments = {}
+_local_integrity = {}
+
+
+def load_manifest():
+    """Build the assets (only what is missing) and load the manifest, done once at startup"""
+    global _manifest
+    _local_integrity.clear()
+    try:
+        _manifest = build(os.path.join(app.root_path, "static"), os.path.join(app.root_path, DIST_FOLDER))
+    except OSError:
+        logging.exception("Could not build the static assets, serving them unhashed")
+        _manifest = {}
+
+
+@app.template_global()
+def asset_url(filename):
+    hashed = _manifest.get(filename)
+    if hashed is None:
+        return url_for("static", filename=filename)
+    return url_for("assets", filename=hashed)
+
+
+@app.template_global()
+def vendor_url(name):
+    """The local copy of a VENDOR library, or its cdn. None for a script that has neither a local copy nor a
+    pinned integrity hash."""
+    cdn_url, local, integrity = VENDOR[name]
+    if local in _manifest:
+        return url_for("assets", filename=_manifest[local])
+    if name.endswith(".js") and not integrity:
+        return None
+    return cdn_url
+
+
+@app.template_global()
+def vendor_integrity(name):
+    """Subresource integrity of what vendor_url links: the hash of the local copy, or the pinned hash of the cdn file"""
+    _, local, integrity = VENDOR[name]
+    if local not in _manifest:
+        return integrity or ""
+    if local not in _local_integrity:
+        with open(os.path.join(app.root_path, DIST_FOLDER, _manifest[local]), "rb") as file:
+            _local_integrity[local] = subresource_integrity(file.read())
+    return _local_integrity[local]
+
+
+@app.route("/assets/<path:filename>")
+def assets(filename):
+    folder = os.path.join(app.root_path, DIST_FOLDER)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    for encoding, extension in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[encoding] and os.path.exists(os.path.join(folder, filename + extension)):
+            response = send_from_directory(folder, filename + extension, mimetype=mimetype)
+            response.headers["Content-Encoding"] = encoding
+            break
+    else:
+        if not os.path.exists(os.path.join(folder, filename)):
+            abort(404)
+        response = send_from_directory(folder, filename, mimetype=mimetype)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = IMMUTABLE
+    return response
+
+
+@app.after_request
+def _cache_product_images(response):
+    if request.endpoint == "static" and response.status_code == 200 and \
+            UUID_FILE_NAME.search(request.view_args.get("filename", "")):
+        response.headers["Cache-Control"] = IMMUTABLE
+    return response
+
+
+@app.template_global()
+def static_fragment(template):
+    """A template without variables, rendered on first use only"""
+    fragment = _fragments.get(template)
+    if fragment is None or app.debug:
+        fragment = _fragments[template] = Markup(render_template(template))
+    return fragment
+
+
+# # # # # # # #  RESPONSE COMPRESSION  # # # # # # # #
+def _compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(body, compresslevel=app.config['COMPRESS_GZIP_LEVEL'])
+
+
+def compress_response(response, compressed=None):
+    """Compress the body of `response` if it is big enough and the browser accepts it. `compressed` keeps the
+    compressed bodies of a cached page, one per encoding."""
+    body = response.get_data()
+    if len(body) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    if brotli is not None and request.accept_encodings["br"]:
+        encoding = "br"
+    elif request.accept_encodings["gzip"]:
+        encoding = "gzip"
+    else:
+        return response
+
+    if compressed is None:
+        data = _compress(body, encoding)
+    else:
+        data = compressed.get(encoding)
+        if data is None:
+            data = compressed[encoding] = _compress(body, encoding)
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)  # same page, other bytes
+    return response
+
+
+@app.after_request
+def _compress_response(response):
+    if response.mimetype not in COMPRESS_MIMETYPES or response.direct_passthrough or response.is_streamed \
+            or response.status_code != 200 or "Content-Encoding" in response.headers:
+        return response
+    return compress_response(response)
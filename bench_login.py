@@ -0,0 +1,104 @@
+"""Login throughput with password hashing on the request threads and in the pool:
+    python bench_login.py [--clients 16] [--logins 64] [--workers 0 2 4]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+EMAIL = "bench@example.com"
+PASSWORD = "bench-password"
+PAGE_INTERVAL_SECONDS = 0.05  # a visitor every 50 ms
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def run(clients, logins):
+    """One benchmark run in this process, settings come from the environment"""
+    from wsgi import app
+    from db_app import db, User, create_schema
+    from user_related_functions import hash_password
+
+    with app.app_context():
+        create_schema()
+        db.session.add(User(name="Bench", surname="User", birthdate="2000-01-01", gender="other",
+                            phone_number_ext="+1", phone_number="5550000", email=EMAIL,
+                            password=hash_password(PASSWORD)))
+        db.session.commit()
+
+    def login(_):
+        started = time.perf_counter()
+        response = app.test_client().post("/login", data={"email": EMAIL, "password": PASSWORD})
+        return response.status_code, time.perf_counter() - started
+
+    page_times = []
+    done = threading.Event()
+
+    def load_pages():
+        client = app.test_client()
+        while not done.is_set():
+            started = time.perf_counter()
+            client.get("/")
+            page_times.append(time.perf_counter() - started)
+            done.wait(PAGE_INTERVAL_SECONDS)
+
+    pages = threading.Thread(target=load_pages)
+    started = time.perf_counter()
+    pages.start()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(login, range(logins)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    pages.join()
+
+    times = [seconds for status, seconds in results if status == 302]
+    return {
+        "workers": app.config['PASSWORD_WORKERS'],
+        "logins_per_second": round(len(times) / elapsed, 1),
+        "login_p50_ms": round(_percentile(times, 50) * 1000),
+        "login_p95_ms": round(_percentile(times, 95) * 1000),
+        "rejected_503": sum(1 for status, _ in results if status == 503),
+        "page_p50_ms": round(_percentile(page_times, 50) * 1000),
+        "page_p95_ms": round(_percentile(page_times, 95) * 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Login throughput under concurrent load")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent login threads")
+    parser.add_argument("--logins", type=int, default=64, help="logins per run")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2], help="PASSWORD_WORKERS values to compare")
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run(args.clients, args.logins)))
+        return
+
+    print(f"{args.logins} logins from {args.clients} threads, {os.cpu_count()} cpus")
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as folder:
+            env = dict(os.environ, DATABASE_URL=f"sqlite:///{folder}/bench.db", SECRET_KEY="bench",
+                       EMAIL_WORKER="off", STRIPE_EVENT_WORKER="off", PASSWORD_WORKERS=str(workers))
+            output = subprocess.run([sys.executable, __file__, "--run", "--clients", str(args.clients),
+                                     "--logins", str(args.logins)],
+                                    env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"workers={result['workers']}: {result['logins_per_second']} logins/s, "
+              f"login p50 {result['login_p50_ms']} ms / p95 {result['login_p95_ms']} ms, "
+              f"{result['rejected_503']} rejected, home page p50 {result['page_p50_ms']} ms / "
+              f"p95 {result['page_p95_ms']} ms")
+
+
+if __name__ == "__main__":
+    main()
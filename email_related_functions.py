@@ -0,0 +1,185 @@
+"""Outgoing emails. Requests only queue them in email_outbox, a background sender delivers them over one SMTP
+connection, order status changes as one digest per customer. Run the sender on its own with:
+    dotenv run -- python email_related_functions.py
+"""
+import logging
+import smtplib
+import time
+from datetime import datetime
+from email.message import EmailMessage
+
+from sqlalchemy import func, or_
+
+from db_app import db, init_extensions, EmailOutbox, OrderNotifications, User, MY_EMAIL, MY_EMAIL_PASSWORD, \
+    SMTP_HOST, SMTP_PORT, SMTP_STARTTLS
+from outbox_related_functions import OutboxWorker
+
+BATCH_SIZE = 20
+MAX_ATTEMPTS = 6
+RETRY_BACKOFF_SECONDS = 30  # 30s, 60s, 2m, 4m, 8m
+SENDING_TIMEOUT_SECONDS = 300  # a "sending" row older than this belonged to a sender that died, send it again
+IDLE_DISCONNECT_SECONDS = 60
+POLL_SECONDS = 5
+DIGEST_QUIET_SECONDS = 60
+DIGEST_MAX_DELAY_SECONDS = 600
+
+email_worker = OutboxWorker(EmailOutbox, "email-sender", busy_status="sending", batch_size=BATCH_SIZE,
+                            max_attempts=MAX_ATTEMPTS, backoff_seconds=RETRY_BACKOFF_SECONDS,
+                            claim_timeout_seconds=SENDING_TIMEOUT_SECONDS, poll_seconds=POLL_SECONDS,
+                            order_by=EmailOutbox.next_attempt_at)
+
+
+def _outbox_email(to_address, subject, body):
+    return EmailOutbox(
+        to_address=to_address,
+        subject=subject,
+        body=body,
+        status="pending",
+        attempts=0,
+        next_attempt_at=time.time(),
+        created_at=datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+    )
+
+
+def queue_email(to_address, subject, body):
+    """Add an email to the outbox. This is all a request has to do, the sender delivers it."""
+    db.session.add(_outbox_email(to_address, subject, body))
+    db.session.commit()
+    email_worker.wake()
+
+
+def notify_order_status(order_detail, status):
+    """Record a status change of an order line for the customer's next digest email"""
+    db.session.add(OrderNotifications(
+        order_number=order_detail.order_number,
+        order_detail_id=order_detail.id,
+        title=order_detail.title,
+        status=status,
+        created_at=time.time(),
+        user_id=order_detail.user_id,
+    ))
+
+
+def _digest_body(user, notifications):
+    lines = [f"Hello {user.name.capitalize()},", "", "There are updates on your orders:"]
+    current_order = None
+    for notification in notifications:
+        if notification.order_number != current_order:
+            current_order = notification.order_number
+            lines += ["", f"Order {current_order}"]
+        lines.append(f" - {notification.title}: {notification.status}")
+    lines += ["", "You can follow your orders on your profile page."]
+    return "\n".join(lines)
+
+
+def queue_order_digests():
+    """Turn the pending notifications of every customer that is due into one outbox email each.
+    Returns the number of digests queued."""
+    now = time.time()
+    due_users = db.session.query(OrderNotifications.user_id)\
+        .filter(OrderNotifications.emailed_at.is_(None))\
+        .group_by(OrderNotifications.user_id)\
+        .having(or_(func.max(OrderNotifications.created_at) <= now - DIGEST_QUIET_SECONDS,
+                    func.min(OrderNotifications.created_at) <= now - DIGEST_MAX_DELAY_SECONDS))\
+        .all()
+
+    queued = 0
+    for (user_id,) in due_users:
+        notifications = OrderNotifications.query.filter_by(user_id=user_id, emailed_at=None)\
+            .order_by(OrderNotifications.order_number, OrderNotifications.id).all()
+        ids = [notification.id for notification in notifications]
+        # claim the notifications, another sender may be building the same digest
+        claimed = OrderNotifications.query.filter(OrderNotifications.id.in_(ids),
+                                                  OrderNotifications.emailed_at.is_(None))\
+            .update({OrderNotifications.emailed_at: now}, synchronize_session=False)
+        if claimed != len(ids):
+            db.session.rollback()
+            continue
+        user = User.query.get(user_id)
+        db.session.add(_outbox_email(user.email, "Your order updates", _digest_body(user, notifications)))
+        db.session.commit()
+        queued += 1
+    return queued
+
+
+class SMTPConnection:
+    """One logged in SMTP connection, reused for every email until it breaks or stays idle too long"""
+
+    def __init__(self):
+        self.smtp = None
+        self.last_used = 0.0
+
+    def send(self, message):
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+            if SMTP_STARTTLS:
+                self.smtp.starttls()
+            if MY_EMAIL_PASSWORD:
+                self.smtp.login(user=MY_EMAIL, password=MY_EMAIL_PASSWORD)
+        self.smtp.send_message(message)
+        self.last_used = time.monotonic()
+
+    def close_if_idle(self):
+        if self.smtp is not None and time.monotonic() - self.last_used > IDLE_DISCONNECT_SECONDS:
+            self.close()
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+
+def _message(email):
+    message = EmailMessage()
+    message["From"] = MY_EMAIL
+    message["To"] = email.to_address
+    message["Subject"] = email.subject
+    message.set_content(email.body)
+    return message
+
+
+def send_due_emails(connection):
+    """Send one batch of due emails over `connection`. Returns how many were taken from the outbox."""
+    emails = email_worker.claim_due()
+    for email in emails:
+        email_id = email.id
+        try:
+            connection.send(_message(email))
+            email.status = "sent"
+            email.last_error = None
+            db.session.commit()
+        except Exception as ex:
+            # any error, not only smtp ones (a bad address header, a lost db connection...), is this email's,
+            # the rest of the batch is still sent
+            db.session.rollback()
+            connection.close()  # reconnect for the next email
+            email = EmailOutbox.query.get(email_id)
+            if email_worker.retry_later(email, ex):
+                logging.error(f"Giving up on email {email.id} to {email.to_address}: {email.last_error}")
+            db.session.commit()
+    return len(emails)
+
+
+def run_email_sender(stop=None):
+    """Send queued emails until `stop` (a threading.Event) is set"""
+    connection = SMTPConnection()
+
+    def send_batch():
+        queue_order_digests()
+        return send_due_emails(connection)
+
+    email_worker.run(send_batch, stop, idle=connection.close_if_idle)
+    connection.close()
+
+
+def start_email_sender():
+    """Start the sender thread of this process, once"""
+    email_worker.start(run_email_sender)
+
+
+if __name__ == "__main__":
+    init_extensions()
+    run_email_sender()
@@ -1,22 +1,34 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from random import randint
+from threading import Lock
+from time import time
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
 from flask import session
-from db_app import MY_EMAIL, MY_EMAIL_PASSWORD
-import smtplib
+from db_app import ORDER_HOST_ID, ORDER_SLOTS_FOLDER
+from email_related_functions import queue_email
 
 
 def send_verification(email: str, verification_code: int):
-    my_email = MY_EMAIL
-    password = MY_EMAIL_PASSWORD
+    # only queued here, the email sender delivers it outside of the request
+    queue_email(
+        to_address=email,
+        subject="Hello",
+        body=f"Please use this verification code to get a new password. \n\n {verification_code}"
+    )
+
 
-    with smtplib.SMTP("smtp.gmail.com", 587) as connection:  # creating an object of smtp, add 587 to prevent error
-        connection.starttls()  # tls means Transport Layer Security,  way of securing our connection to our email server
-        connection.login(user=my_email, password=password)
-        connection.sendmail(
-            from_addr=my_email,
-            to_addrs=email,
-            msg=f"Subject:Hello\n\n Please use this verification code to get a new password. \n\n {verification_code}"
-        )
+def process_pool(max_workers):
+    """Process pool whose workers are not forks of the app, with its threads, locks and database connections"""
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
 
 
 def current_date():
@@ -35,36 +47,71 @@ def generate_random_code():
     range_end = (10 ** digit) - 1
     generated_code = randint(range_start, range_end)
     session["code"] = generated_code
-    return True
+    return generated_code
+
+
+# Snowflake style order numbers: | 41 bits ms since ORDER_EPOCH_MS | 3 bits host | 7 bits process | 12 bits sequence |
+# Time ordered and made in memory without asking the db. The host bits are ORDER_HOST_ID, a different one for every
+# host. The process bits are a slot the process claims once, by locking one of the slot files in ORDER_SLOTS_FOLDER.
+# The lock is held until the process exits (the OS drops it even if the process is killed), so no two living
+# processes of a host ever have the same slot and no two orders the same number.
+ORDER_EPOCH_MS = 1704067200000  # 2024-01-01 UTC, 41 bits of ms last until 2093
+ORDER_SEQUENCE_BITS = 12
+ORDER_PROCESS_BITS = 7
+ORDER_HOST_BITS = 3
+_order_lock = Lock()
+_order_state = {"pid": None, "slot_file": None, "node": 0, "last_ms": 0, "sequence": 0}
+
+
+def _check_host_id(host_id):
+    # a host id out of range would share its host bits with another host, checked when the app starts
+    if not 0 <= host_id < 2 ** ORDER_HOST_BITS:
+        raise ValueError(f"ORDER_HOST_ID must be between 0 and {2 ** ORDER_HOST_BITS - 1}, not {host_id}")
+
+
+_check_host_id(ORDER_HOST_ID)
+
+
+def _lock_file(file):
+    """Lock an open file without waiting, False if another process holds the lock"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _claim_order_slot():
+    """Lock the first free slot file of this host. Returns (slot, open slot file), the file must stay open."""
+    os.makedirs(ORDER_SLOTS_FOLDER, exist_ok=True)
+    for slot in range(2 ** ORDER_PROCESS_BITS):
+        file = open(os.path.join(ORDER_SLOTS_FOLDER, f"slot-{slot}.lock"), "a+")
+        if _lock_file(file):
+            return slot, file
+        file.close()
+    raise RuntimeError(f"All {2 ** ORDER_PROCESS_BITS} order number slots of this host are taken")
 
 
 def order_num():
-    digit = 10
-    range_start = 10 ** (digit - 1)
-    range_end = (10 ** digit) - 1
-    generated_code = str(randint(range_start, range_end))
-    first_index_num = randint(0, 7)
-    random_index = randint(1, 9)
-    random_index_num = randint(0, 7)
-
-    nums = []
-    for num in generated_code:
-        nums.append(num)
-
-    for idx, num in enumerate(nums):
-        if idx == 0:
-            nums[idx] = str(first_index_num)
-        if idx == random_index:
-            nums[idx] = str(random_index_num)
-
-    changed_num = ""
-    for number in nums:
-        changed_num += number
-
-    digit_new = 4
-    range_start_new = 2 ** (digit_new - 1)
-    range_end_new = (2 ** digit_new) - 1
-    generated_code_new = str(randint(range_start_new, range_end_new))
-    final_order_num = changed_num + generated_code_new
-    print(int(final_order_num))
-    return int(final_order_num)
+    """A new unique order number, greater than every order number this process made before"""
+    with _order_lock:
+        state = _order_state
+        if state["pid"] != os.getpid():  # first call, or a forked worker that inherited its parent's state
+            if state["slot_file"] is not None:
+                state["slot_file"].close()  # the parent's slot, it stays locked by the parent
+            slot, slot_file = _claim_order_slot()
+            state.update(pid=os.getpid(), slot_file=slot_file, last_ms=0, sequence=0,
+                         node=ORDER_HOST_ID << ORDER_PROCESS_BITS | slot)
+        now_ms = int(time() * 1000) - ORDER_EPOCH_MS
+        if now_ms > state["last_ms"]:
+            state["last_ms"], state["sequence"] = now_ms, 0
+        else:
+            # same ms, or the clock went back: count on from the last number instead of waiting
+            state["sequence"] += 1
+            if state["sequence"] == 2 ** ORDER_SEQUENCE_BITS:
+                state["last_ms"], state["sequence"] = state["last_ms"] + 1, 0
+        return (state["last_ms"] << (ORDER_HOST_BITS + ORDER_PROCESS_BITS + ORDER_SEQUENCE_BITS)) \
+            | (state["node"] << ORDER_SEQUENCE_BITS) | state["sequence"]
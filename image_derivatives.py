@@ -0,0 +1,98 @@
+"""Thumb, card and zoom copies (jpg and webp) of the product images, in DERIVED_FOLDER. Does not import the app.
+Convert the existing images (needs Pillow) with:
+    python image_derivatives.py [--force]
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+IMAGES_FOLDER = "static/images"
+DERIVED_FOLDER = "static/images/derived"
+SKIP_FOLDERS = {"derived", ".staging"}
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+
+# name: max width in px, smallest first
+SIZES = {"thumb": 160, "card": 480, "zoom": 1200}
+FORMATS = {
+    "jpg": ("JPEG", {"quality": 82, "optimize": True, "progressive": True}),
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+}
+# written last, a derivative set is complete once this file exists
+LAST_DERIVATIVE = ("zoom", "webp")
+
+
+def derivative_path(original, size, fmt):
+    name = os.path.splitext(os.path.relpath(original, IMAGES_FOLDER))[0]
+    return f"{DERIVED_FOLDER}/{name}-{size}.{fmt}".replace(os.sep, "/")
+
+
+def has_derivatives(original):
+    """False for a product without this image (original is None) too"""
+    return bool(original) and os.path.exists(derivative_path(original, *LAST_DERIVATIVE))
+
+
+def _rgb(image):
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def make_derivatives(original, force=False):
+    """Write every size and format of one original. Returns the number of files written."""
+    if Image is None:
+        return 0
+    if not force and has_derivatives(original) and \
+            os.path.getmtime(derivative_path(original, *LAST_DERIVATIVE)) >= os.path.getmtime(original):
+        return 0
+
+    with Image.open(original) as image:
+        image = _rgb(image)
+    written = 0
+    for size, width in SIZES.items():
+        resized = image.copy()
+        resized.thumbnail((width, width * 4), Image.LANCZOS)  # never upscales
+        for fmt, (pil_format, options) in FORMATS.items():
+            path = derivative_path(original, size, fmt)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write next to the target and rename, a page never links a half written file
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            resized.save(temp_path, pil_format, **options)
+            os.replace(temp_path, path)
+            written += 1
+    return written
+
+
+def find_originals(folder=IMAGES_FOLDER):
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if d not in SKIP_FOLDERS]
+        for file in sorted(files):
+            if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(root, file).replace(os.sep, "/")
+
+
+def backfill(folder=IMAGES_FOLDER, force=False, workers=None):
+    """Make the missing derivatives of every original in `folder`. Returns (originals, files written)."""
+    originals = list(find_originals(folder))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        written = sum(pool.map(make_derivatives, originals, [force] * len(originals)))
+    return len(originals), written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make the thumbnail, card and zoom copies of product images")
+    parser.add_argument("--force", action="store_true", help="write them again even if they are up to date")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default: cpu count")
+    args = parser.parse_args()
+    if Image is None:
+        raise SystemExit("Pillow is not installed: pip install Pillow")
+    count, written = backfill(force=args.force, workers=args.workers)
+    print(f"{count} images, {written} files written to {DERIVED_FOLDER}")
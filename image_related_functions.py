@@ -0,0 +1,111 @@
+"""Product image uploads, streamed into UPLOAD_STAGING_FOLDER and moved into their product directory, and their
+sized copies."""
+import logging
+import os
+import shutil
+import tempfile
+from uuid import uuid4
+
+from flask import Request, request
+from werkzeug.utils import secure_filename
+
+from db_app import app, ALLOWED_EXTENSIONS
+from functions import process_pool
+from image_derivatives import SIZES, derivative_path, has_derivatives, make_derivatives
+
+_image_pool = None
+
+
+class UploadRequest(Request):
+    """Streams uploaded files straight into the staging folder"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.staged_files = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        staging_folder = app.config['UPLOAD_STAGING_FOLDER']
+        os.makedirs(staging_folder, exist_ok=True)
+        stream = tempfile.NamedTemporaryFile("wb+", dir=staging_folder, prefix="upload-", delete=False)
+        self.staged_files.append(stream.name)
+        return stream
+
+
+app.request_class = UploadRequest
+
+
+@app.teardown_request
+def _remove_staged_files(exception=None):
+    for path in getattr(request, "staged_files", []):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # published
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+# To make each filename unique incase user uploads files with duplicate names.
+def make_unique(string):
+    uuid = uuid4().__str__()
+    return f"{uuid}-{string}"
+
+
+def publish_uploads(files, product_dir):
+    """Move the uploaded `files` into the new directory `product_dir`, in upload order.
+    Returns the image paths. Raises FileExistsError if the directory already exists."""
+    os.makedirs(os.path.dirname(product_dir), exist_ok=True)
+    os.mkdir(product_dir)
+    image_paths = []
+    for file in files:
+        image_path = product_dir + "/" + make_unique(secure_filename(file.filename))
+        staged_path = getattr(file.stream, "name", None)
+        if staged_path in getattr(request, "staged_files", []):
+            file.stream.close()
+            os.replace(staged_path, image_path)
+        else:
+            file.save(image_path)  # not parsed by UploadRequest
+        image_paths.append(image_path)
+    return image_paths
+
+
+def discard_uploads(product_dir):
+    """Remove a published product directory again, when its product could not be saved"""
+    shutil.rmtree(product_dir, ignore_errors=True)
+
+
+# # # # # # # #  DERIVATIVES  # # # # # # # #
+def _log_failure(future):
+    if future.exception() is not None:
+        logging.error(f"Could not make image derivatives: {future.exception()!r}")
+
+
+def queue_derivatives(image_paths):
+    """Make the sized copies of new images in the image pool, without waiting for them"""
+    global _image_pool
+    if _image_pool is None:
+        _image_pool = process_pool(app.config['IMAGE_WORKERS'])
+    for path in image_paths:
+        if path:
+            _image_pool.submit(make_derivatives, path).add_done_callback(_log_failure)
+
+
+@app.template_global()
+def image_url(path, size="card"):
+    """URL of the jpg copy of an image in `size`, or of the original while the copies are not made yet.
+    "" for an image the product does not have."""
+    if not path:
+        return ""
+    if has_derivatives(path):
+        return "/" + derivative_path(path, size, "jpg")
+    return "/" + path
+
+
+@app.template_global()
+def image_srcset(path, fmt="jpg"):
+    """srcset of every size of an image, "" while the copies are not made yet"""
+    if not has_derivatives(path):
+        return ""
+    return ", ".join(f"/{derivative_path(path, size, fmt)} {width}w" for size, width in SIZES.items())
@@ -1,44 +1,73 @@
 import sqlalchemy.exc
 
-from flask import render_template, redirect, url_for, flash, request, session, jsonify, abort
+from flask import render_template, redirect, url_for, flash, request, session, jsonify, abort, make_response
 from flask_login import login_user, current_user, logout_user, login_required
 
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 
-from db_app import app, db, login_manager, User, AdminUser, UserAddresses, UserBillingAddresses, UserCart, UserFav, \
-    Products, VariationProducts, Orders, OrderDetails, Returns, CancelledOrders, TrackingInformation, \
-    stripe_keys, endpoint_secret
+from db_app import app, db, login_manager, init_extensions, create_schema, User, AdminUser, UserAddresses, \
+    UserBillingAddresses, UserCart, UserFav, Products, VariationProducts, Orders, OrderDetails, Returns, \
+    CancelledOrders, TrackingInformation, stripe_keys, endpoint_secret
 
 from functions import order_num, current_date, generate_random_code, send_verification
-from order_related_functions import add_order_details
+from order_related_functions import add_order_details, reserve_stock, release_stock, STATUS_PAYMENT_PENDING, \
+    STATUS_PAYMENT_FAILED
+from email_related_functions import start_email_sender, notify_order_status
+from asset_related_functions import load_manifest, compress_response
+from image_related_functions import allowed_file, publish_uploads, discard_uploads, queue_derivatives
+from user_related_functions import get_principal, forget_principal, check_login, hash_password, verify_password
+from payment_related_functions import queue_checkout, wake_event_consumer, save_stripe_event, start_event_consumer
+from product_related_functions import get_parent_products, invalidate_catalog, index_product, unindex_product, \
+    product_page, cached_product_page, search_products, search_inventory_page, inventory_page, load_product_page, \
+    update_carts_and_favs, catalog_version, cached_page, store_page, RenderedPage
 
-import os
 import stripe
 from stripe import error
 
+import hashlib
 import logging
-from uuid import uuid4
+import os
 from functools import wraps
+from threading import Lock
+
+_serving_lock = Lock()
+_serving = False
+
+
+def _start_serving():
+    """Load the asset manifest and start the background workers, on the first request of the process"""
+    global _serving
+    if _serving:
+        return
+    with _serving_lock:
+        if _serving:
+            return
+        load_manifest()
+        if app.config['EMAIL_WORKER'] == "thread":
+            start_email_sender()
+        if app.config['STRIPE_EVENT_WORKER'] == "thread":
+            start_event_consumer()
+        _serving = True
+
 
-UPLOAD_FOLDER = "static/images/"
-BASE_PATH = ""
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+def create_app():
+    """The app, ready to serve requests in this process. Importing main only registers the routes."""
+    init_extensions()
+    if _start_serving not in app.before_request_funcs.get(None, []):
+        app.before_request(_start_serving)
+    return app
 
 
 # # # # # # # #  DECORATORS  # # # # # # # #
 @login_manager.user_loader
 def load_user(user_id):
-    if int(user_id) > 1000:
-        return AdminUser.query.get(int(user_id))
-    else:
-        return User.query.get(int(user_id))
+    return get_principal(user_id)
 
 
 def admin_only(func):
     @wraps(func)
     def check_id(*args, **kwargs):
-        if int(current_user.id) < 1000:
+        if not getattr(current_user, "is_admin", False):
             raise abort(403)
         else:
             return func(*args, **kwargs)
@@ -46,23 +75,50 @@ def admin_only(func):
     return check_id
 
 
+def anonymous_page_cache(func):
+    """Serve GETs of visitors that are not logged in from the rendered page cache, which is dropped whenever the
+    catalog changes. Answers 304 when the browser already has the page (ETag is a hash of the page)."""
+    @wraps(func)
+    def cached_view(*args, **kwargs):
+        if request.method != "GET" or current_user.is_authenticated or session.get("_flashes"):
+            return func(*args, **kwargs)
+
+        key = request.full_path
+        page = cached_page(key)
+        if page is None:
+            version = catalog_version()
+            response = make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            headers = {name: value for name, value in response.headers.items()
+                       if name in ("Content-Type", "X-Next-Url")}
+            page = RenderedPage(body, headers, hashlib.sha1(body).hexdigest()[:20], {})
+            store_page(key, page, version)
+
+        response = make_response(page.body, 200, page.headers)
+        response.set_etag(page.etag)
+        compress_response(response, page.compressed)
+        # browsers keep the page but ask again every time, logging in changes the cookie and the page
+        response.headers["Cache-Control"] = "no-cache"
+        response.vary.add("Cookie")
+        return response.make_conditional(request)
+
+    return cached_view
+
+
 # # # # # # # # # # # # # # # # # # # # # # ----USER RELATED----  # # # # # # # # # # # # # # # # # # # # # #
 # # # # # # # #  USER PROFILE ROUTE FUNCTIONS # # # # # # # #
 @app.route("/")
+@anonymous_page_cache
 def home():
     if current_user.is_authenticated:
         user_name = current_user.name.capitalize()
-        p_products_all = Products.query.all()
-        v_products_all = VariationProducts.query.all()
-        products_all = []
-        for p in p_products_all:
-            products_all.append(p)
-        for v in v_products_all:
-            products_all.append(v)
-        return render_template("index.html", name=user_name, products=products_all)
+        page = cached_product_page(request.args.get("after"), request.args.get("limit"))
+        return product_listing("index.html", "index_cards.html", page, "home", name=user_name)
     else:
-        products_all = Products.query.all()
-        return render_template("index.html", products=products_all)
+        page = cached_product_page(request.args.get("after"), request.args.get("limit"), include_variations=False)
+        return product_listing("index.html", "index_cards.html", page, "home")
 
 
 @app.route("/profile")
@@ -82,7 +138,7 @@ def favourites():
         user_favs = UserFav.query.filter_by(user_id=current_user.id).all()
         if len(user_favs) == 0:
             user_favs = "empty"
-        products_all = Products.query.all()
+        products_all = get_parent_products()
         return render_template("favourites.html", fav_products=user_favs, products_all=products_all)
     else:
         return redirect(url_for("login"))
@@ -260,11 +316,12 @@ def profile_settings():
             update_user.phone_number = request.form.get("phone_number")
             update_user.birthdate = request.form.get("birthdate")
             update_user.email = request.form.get("email")
+            forget_principal(update_user.id)
 
             db.session.commit()
 
             return redirect(url_for("profile_settings"))
-        return render_template("profile_settings.html", user=current_user)
+        return render_template("profile_settings.html", user=User.query.get(current_user.id))
 
 
 @app.route("/profile-settings/<status>", methods=["GET", "POST"])
@@ -275,14 +332,13 @@ def change_password(status):
     if status == "True":
         user = User.query.filter_by(id=current_user.id).first()
         current_password_entered = request.form.get("current_password")
-        if check_password_hash(user.password, current_password_entered):
+        if verify_password(user.password, current_password_entered):
             new_pw = request.form.get("new_password")
             new_pw_repeat = request.form.get("new_password_repeat")
             if new_pw == new_pw_repeat:
-                hashed_pw = generate_password_hash(password=new_pw,
-                                                   method="pbkdf2:sha256",
-                                                   salt_length=8)
+                hashed_pw = hash_password(new_pw)
                 user.password = hashed_pw
+                forget_principal(user.id)
                 db.session.commit()
                 flash("Password has been changed.", "password_flash")
                 return redirect(url_for("profile_settings"))
@@ -333,9 +389,10 @@ def setup_new_password():
         password = request.form.get("password")
         password_repeat = request.form.get("password_repeat")
         if password == password_repeat:
-            hashed_pw = generate_password_hash(password=password, method="pbkdf2:sha256", salt_length=8)
+            hashed_pw = hash_password(password)
             user = User.query.filter_by(email=session["email"]).first()
             user.password = hashed_pw
+            forget_principal(user.id)
             db.session.commit()
             return redirect(url_for("login"))
         else:
@@ -406,6 +463,12 @@ def add_user_address():
 @login_required
 def delete_address(address_id, address_type):
     user = User.query.filter_by(id=current_user.id).first().id
+    # an order waiting for its payment ships to its addresses once it is charged, see finalize_order
+    address_column = Orders.delivery_address_ids if address_type == "delivery" else Orders.billing_address_ids
+    if Orders.query.filter(address_column == address_id, Orders.user_id == user,
+                           Orders.payment_status == STATUS_PAYMENT_PENDING).first() is not None:
+        flash("This address is used by an order waiting for its payment, please try again later.", "address")
+        return redirect(request.referrer)
     if address_type == "delivery":
         address_owner = UserAddresses.query.filter_by(id=address_id).first().user_id
         if user == address_owner:
@@ -474,7 +537,7 @@ def cart():
         total = 0
         for t_price in cart_items_all:
             total += t_price.total_price
-        products_all = Products.query.all()
+        products_all = get_parent_products()
         return render_template("cart.html",
                                cart=cart_items_all,
                                item_count=cart_len,
@@ -624,99 +687,93 @@ def checkout():
 def make_purchase(user_id, amount):
     if request.method == "POST":
         if current_user.is_authenticated:
-            # First charge the payment, then add the order to db
+            user = User.query.filter_by(id=user_id).first()
+            cart_items_all = UserCart.query.filter_by(user_id=user.id).all()
+
+            # First reserve the stock, then charge the payment, then add the order to db
+            out_of_stock = reserve_stock(cart_items_all)
+            if out_of_stock:
+                for item in out_of_stock:
+                    flash(f"There is not enough stock left for {item.title} x {item.quantity}. "
+                          f"Please lower the quantity.", "cart")
+                return redirect(url_for("cart"))
+
+            order_placed = False
             # Amount in cents
             cost = round(float(amount) * 100)
             try:
-                customer = stripe.Customer.create(
-                    email='customer@example.com',
-                    source=request.form['stripeToken']
-                )
-
-                charge = stripe.Charge.create(
-                    customer=customer.id,
-                    amount=cost,
-                    currency='usd',
-                    description='Purchase Payment'
-                )
-                if charge.status == "succeeded":
-                    logging.info("successful transaction")
-                    user = User.query.filter_by(id=user_id).first()
-                    cart_items_all = UserCart.query.filter_by(user_id=user.id).all()
-
-                    total_order_value = 0
-                    for t_price in cart_items_all:
-                        total_order_value += t_price.total_price
-
-                    order_item_product_identifiers_list = [p.product_identifier for p in cart_items_all]
-                    order_item_product_identifiers = "".join(str(p) + " " for p in order_item_product_identifiers_list)
-
-                    order_number = order_num()
-                    delivery_address_id = request.form.get("delivery_address")
-                    billing_address_id = request.form.get("billing_address")
-
-                    new_order = Orders(
-                        order_number=order_number,
-                        product_identifiers=order_item_product_identifiers,
-                        customer_name=user.name,
-                        customer_surname=user.surname,
-                        delivery_address_ids=delivery_address_id,
-                        billing_address_ids=billing_address_id,
-                        delivery_cost=0,
-                        total_order_value=round(total_order_value, 2),
-                        order_date=current_date(),
-                        payment_status=charge.status,
-                        shipment_status="Being Prepared",
-                        user_id=current_user.id
-                    )
-                    db.session.add(new_order)
-                    db.session.commit()
+                total_order_value = 0
+                for t_price in cart_items_all:
+                    total_order_value += t_price.total_price
 
-                    add_order_details(cart_items_all, order_number, user_id)
-                    logging.info("No error.")
+                order_item_product_identifiers_list = [p.product_identifier for p in cart_items_all]
+                order_item_product_identifiers = "".join(str(p) + " " for p in order_item_product_identifiers_list)
 
-                    # create dict of title X quantity: cost
+                order_number = order_num()
+                delivery_address_id = request.form.get("delivery_address")
+                billing_address_id = request.form.get("billing_address")
 
-                    purchased_info = {}
-                    for p in cart_items_all:
-                        purchased_info[f"{p.title} x {p.quantity}"] = p.total_price
-                    print(purchased_info)
-
-                    return render_template("charge.html",
-                                           amount=amount,
-                                           user_name=current_user.name + " " + current_user.surname,
-                                           products=purchased_info,
-                                           order_number=order_number,
-                                           order_date=current_date()
-                                           )
-
-                elif charge.status == "pending":
-                    logging.error("pending payment")
-
-                elif charge.status == "failed":
-                    logging.error("payment failed")
-                    payment_error(charge.status)
-
-            except stripe.error.CardError as ex:
-                logging.error("A payment error occurred: {}".format(ex.user_message))
-                payment_error(ex.user_message)
-
-            except stripe.error.InvalidRequestError:
-                logging.error("An invalid request occurred.")
-                payment_error("An invalid request occurred")
+                new_order = Orders(
+                    order_number=order_number,
+                    product_identifiers=order_item_product_identifiers,
+                    customer_name=user.name,
+                    customer_surname=user.surname,
+                    delivery_address_ids=delivery_address_id,
+                    billing_address_ids=billing_address_id,
+                    delivery_cost=0,
+                    total_order_value=round(total_order_value, 2),
+                    order_date=current_date(),
+                    payment_status=STATUS_PAYMENT_PENDING,
+                    shipment_status=STATUS_PAYMENT_PENDING,
+                    user_id=current_user.id
+                )
+                db.session.add(new_order)
+                # the card is charged by the stripe event consumer, charge.html polls until the order is settled
+                queue_checkout(new_order, request.form['stripeToken'], cost)
+                # the order, its details and the queued payment are committed together
+                add_order_details(cart_items_all, new_order, user_id)
+                order_placed = True
+                wake_event_consumer()
+
+                # create dict of title X quantity: cost
+
+                purchased_info = {}
+                for p in cart_items_all:
+                    purchased_info[f"{p.title} x {p.quantity}"] = p.total_price
+
+                return render_template("charge.html",
+                                       amount=amount,
+                                       user_name=current_user.name + " " + current_user.surname,
+                                       products=purchased_info,
+                                       order_number=order_number,
+                                       order_date=current_date()
+                                       )
 
             except Exception as ex:
                 template = "An exception of type {0} occurred. Arguments:\n{1!r}"
                 message = template.format(type(ex).__name__, ex.args)
-                logging.error("Another problem occurred, maybe unrelated to Stripe.")
+                logging.error("Could not place the order.")
                 payment_error(message)
 
-            # finally:
-            #     return render_template('charge.html', amount=cost)
+            finally:
+                if not order_placed:
+                    release_stock(cart_items_all)
         return redirect(request.referrer)
     return redirect(request.referrer)
 
 
+@app.route("/checkout/order_status/<order_number>/", methods=["GET"])
+@login_required
+def order_payment_status(order_number):
+    """Polled by charge.html until the payment of a new order is settled"""
+    order = Orders.query.filter_by(order_number=order_number, user_id=current_user.id).first()
+    if order is None:
+        abort(404)
+    return jsonify(payment_status=order.payment_status,
+                   shipment_status=order.shipment_status,
+                   settled=order.payment_status != STATUS_PAYMENT_PENDING)
+
+
 @app.route("/payment_error/<exception>/", methods=["GET"])
 def payment_error(exception):
     logging.error(exception)
@@ -726,26 +783,22 @@ def payment_error(exception):
 @app.route('/webhook', methods=['POST'])
 def webhook():
     payload = request.data
-    sig_header = request.headers['STRIPE_SIGNATURE']
+    sig_header = request.headers.get('STRIPE_SIGNATURE')
 
     try:
         event = stripe.Webhook.construct_event(
             payload, sig_header, endpoint_secret
         )
-    except ValueError as e:
+    except ValueError:
         # Invalid payload
-        raise e
-    except stripe.error.SignatureVerificationError as e:
+        return jsonify(success=False), 400
+    except stripe.error.SignatureVerificationError:
         # Invalid signature
-        raise e
+        return jsonify(success=False), 400
 
-    # Handle the event
-    if event['type'] == 'payment_intent.succeeded':
-        payment_intent = event['data']['object']
-        print(payment_intent)
-    # ... handle other event types
-    else:
-        print('Unhandled event type {}'.format(event['type']))
+    # only saved here and acknowledged, the event consumer does the work (see payment_related_functions.py)
+    if not save_stripe_event(event, payload):
+        logging.info(f"Stripe event {event['id']} was already received")
 
     return jsonify(success=True)
 
@@ -826,6 +879,7 @@ def cancel_order(order_detail_id, order_id, order_number, product_id, product_id
                     user_id=current_user.id
                 )
                 current_order_detail.order_status = "Cancelled"
+                notify_order_status(current_order_detail, "Cancelled")
                 order_detail_status_all = []
                 # check all order details to see if every purchase has been cancelled
                 order_details_all = OrderDetails.query.filter_by(order_number=order_number, user_id=user_id).all()
@@ -936,197 +990,126 @@ def return_order_detail_page():
 
 
 # # # # # # # #  PRODUCT RELATED ROUTES / FUNCTIONS # # # # # # # #
+FILTER_FIELDS = ["price_filter", "color_filter", "type_filter", "in_stock_filter"]
+
+
+def product_listing(template, cards_template, page, endpoint, next_url_args=None, **context):
+    """Render one page of a product listing. "?partial=1" (used by the load more button)
+    returns only the cards, with the next page's url in the X-Next-Url header."""
+    next_url = None
+    if page.next_cursor is not None:
+        next_url = url_for(endpoint, after=page.next_cursor, limit=request.args.get("limit"), **(next_url_args or {}))
+
+    if request.args.get("partial"):
+        response = make_response(render_template(cards_template, products=page.products))
+        response.headers["X-Next-Url"] = next_url or ""
+        return response
+    return render_template(template, products=page.products, next_url=next_url, **context)
+
+
 @app.route("/products")
+@anonymous_page_cache
 def products():
-    p_products_all = Products.query.all()
-    v_products_all = VariationProducts.query.all()
-    products_all = []
-    for p in p_products_all:
-        products_all.append(p)
-    for v in v_products_all:
-        products_all.append(v)
+    page = cached_product_page(request.args.get("after"), request.args.get("limit"))
+    return product_listing("products.html", "product_cards.html", page, "products")
+
 
-    return render_template("products.html", products=products_all)
+@app.route("/search")
+def search():
+    search_text = request.args.get("search", "")
+    if not search_text.strip():
+        return redirect(url_for("products"))
+    found_products = search_products(search_text)
+    if len(found_products) == 0:
+        flash(f"No products found for '{search_text}'.", "filter_search")
+    return render_template("products.html", products=found_products)
+
+
+@app.route("/products/filtered")
+def filtered_products():
+    return handle_user_filter()
 
 
 @app.route("/products", methods=["GET", "POST"])
 def handle_user_filter():
-    if request.method == "POST":
-        minimum_price = 0
-        maximum_price = 0
-
-        if request.form["price_filter"] == "All-Prices":
-            price_filter = "all"
+    # first page comes from the filter form (POST), next pages from the load more link (GET /products/filtered)
+    if request.method == "POST" or request.endpoint == "filtered_products":
+        filter_values = {field: request.values.get(field) for field in FILTER_FIELDS
+                         if request.values.get(field) is not None}
+
+        price_filter = filter_values.get("price_filter", "All-Prices")
+        if price_filter == "All-Prices":
+            price_filter = None
         else:
+            minimum_price, maximum_price = price_filter.split()
+            price_filter = (float(minimum_price), float(maximum_price))
 
-            price_filter = request.form["price_filter"].split()
-            minimum_price += float(price_filter[0])
-            maximum_price += float(price_filter[1])
+        color_filter = filter_values.get("color_filter", "All-Colors")
+        if color_filter == "All-Colors":
+            color_filter = None
 
-        if request.form["color_filter"] == "All-Colors":
-            color_filter = "all"
-        else:
-            color_filter = request.form["color_filter"]
-
-        requested_type = []
-        # if all 3 filters selected with All Prices
-        if price_filter == "all" and color_filter == "all":
-            requested_type.append(Products.query.all())
-            return render_template("products.html", products=requested_type[0])
-
-        # if all filters are selected other than All Prices
-        if price_filter != "all" and color_filter != "all":
-            for p in Products.query.all():
-                if minimum_price < p.price < maximum_price and \
-                        color_filter in p.color.split():
-                    requested_type.append(p)
-
-        # if only 1 filter is selected other than All Prices
-        elif price_filter == "all" and color_filter != "all":
-            for p in Products.query.all():
-                if color_filter in p.color.split():
-                    requested_type.append(p)
-
-        elif price_filter == "all" and color_filter != "all":
-            for p in Products.query.all():
-                if color_filter in p.color.split():
-                    requested_type.append(p)
-
-        elif price_filter != "all" and color_filter == "all":
-            for p in Products.query.all():
-                if minimum_price < p.price < maximum_price:
-                    requested_type.append(p)
-
-        # if 2 inputs are different from All Prices
-        elif price_filter == "all" and color_filter != "all":
-            for p in Products.query.all():
-                if color_filter in p.color.split():
-                    requested_type.append(p)
-
-        elif price_filter != "all" and color_filter != "all":
-            for p in Products.query.all():
-                if minimum_price < p.price < maximum_price and color_filter in p.color.split():
-                    requested_type.append(p)
-
-        elif price_filter != "all" and color_filter == "all":
-            for p in Products.query.all():
-                if minimum_price < p.price < maximum_price:
-                    requested_type.append(p)
-
-        if len(requested_type) == 0:
+        type_filter = filter_values.get("type_filter", "All-Types")
+        if type_filter == "All-Types":
+            type_filter = None
+
+        in_stock_filter = True if filter_values.get("in_stock_filter") else None
+
+        page = product_page(request.args.get("after"), request.args.get("limit"),
+                            price=price_filter,
+                            color=color_filter,
+                            product_type=type_filter,
+                            in_stock=in_stock_filter)
+
+        if len(page.products) == 0 and request.args.get("after") is None:
             flash("Filter is not matching with any available products. We are showing you all the products right now.",
                   "filter_search")
-            return render_template("products.html", products=Products.query.all())
-        return render_template("products.html", products=requested_type)
+            page = cached_product_page(limit=request.args.get("limit"))
+            return product_listing("products.html", "product_cards.html", page, "products")
+        return product_listing("products.html", "product_cards.html", page, "filtered_products",
+                               next_url_args=filter_values)
     return redirect(request.referrer)
 
 
-@app.route("/product/parent/<id>/<product_identifier>/")
-def product(id, product_identifier):
-    product_to_show = Products.query.filter_by(id=id, product_identifier=product_identifier).first()
-    if product_to_show is None:
-        return redirect(url_for("show_variation_product", id=id, product_identifier=product_identifier))
-
-    color = product_to_show.color
-    quantity = product_to_show.stock
-    variations = VariationProducts.query.filter_by(parent_product_identifier=product_to_show.product_identifier).all()
+def render_product_page(page_data):
     variation_dic = {}
-    for var in variations:
+    for var in page_data.variations:
         variation_dic[var] = var.color
 
+    fav_status = None
+    fav_id = None
     if current_user.is_authenticated:
-        if not UserFav.query.filter_by(product_id=id,
-                                       product_identifier=product_identifier,
-                                       user_id=current_user.id).first() is None:
-            fav_status = "Added"
-            fav_id = UserFav.query.filter_by(product_id=id, user_id=current_user.id).first().id
-            return render_template("product.html",
-                                   product_to_show=product_to_show,
-                                   parent_product=product_to_show,
-                                   color=color,
-                                   selected_color=product_to_show.color,
-                                   var_color=variation_dic,
-                                   stock=quantity,
-                                   fav_status=fav_status,
-                                   fav_id=fav_id,
-                                   variations=variations
-                                   )
-        else:
-            fav_status = "NotAdded"
-            return render_template("product.html",
-                                   product_to_show=product_to_show,
-                                   parent_product=product_to_show,
-                                   color=color,
-                                   selected_color=product_to_show.color,
-                                   var_color=variation_dic,
-                                   stock=quantity,
-                                   fav_status=fav_status,
-                                   )
-    else:
-        return render_template("product.html",
-                               product_to_show=product_to_show,
-                               parent_product=product_to_show,
-                               color=color,
-                               selected_color=product_to_show.color,
-                               var_color=variation_dic,
-                               stock=quantity,
-                               )
+        fav_status = "NotAdded" if page_data.fav is None else "Added"
+        fav_id = None if page_data.fav is None else page_data.fav.id
+
+    return render_template("product.html",
+                           product_to_show=page_data.product,
+                           parent_product=page_data.parent,
+                           color=page_data.parent.color,
+                           selected_color=page_data.product.color,
+                           var_color=variation_dic,
+                           stock=page_data.product.stock,
+                           fav_status=fav_status,
+                           fav_id=fav_id,
+                           variations=page_data.variations
+                           )
+
+
+@app.route("/product/parent/<id>/<product_identifier>/")
+def product(id, product_identifier):
+    user_id = current_user.id if current_user.is_authenticated else None
+    page_data = load_product_page(Products, id, product_identifier, user_id)
+    if page_data is None:
+        return redirect(url_for("show_variation_product", id=id, product_identifier=product_identifier))
+    return render_product_page(page_data)
 
 
 @app.route("/product/variation/<id>/<product_identifier>/", methods=["GET", "POST"])
 def show_variation_product(id, product_identifier):
-    variation_product = VariationProducts.query.filter_by(id=id, product_identifier=product_identifier).first()
-    if variation_product is None:  # check if the product is deleted from db by admin
+    user_id = current_user.id if current_user.is_authenticated else None
+    page_data = load_product_page(VariationProducts, id, product_identifier, user_id)
+    if page_data is None or page_data.parent is None:  # check if the product is deleted from db by admin
         return render_template("product_not_found.html")
-
-    parent_product = Products.query.filter_by(product_identifier=variation_product.parent_product_identifier).first()
-
-    color = parent_product.color
-    quantity = variation_product.stock
-    variations = VariationProducts.query.filter_by(parent_product_identifier=parent_product.product_identifier).all()
-    variation_dic = {}
-    for var in variations:
-        variation_dic[var] = var.color
-
-    selected_color = variation_product.color
-
-    if current_user.is_authenticated:
-        if not UserFav.query.filter_by(product_id=id,
-                                       product_identifier=product_identifier,
-                                       user_id=current_user.id).first() is None:
-            fav_status = "Added"
-            fav_id = UserFav.query.filter_by(product_id=id, user_id=current_user.id).first().id
-            return render_template("product.html",
-                                   product_to_show=variation_product,
-                                   parent_product=parent_product,
-                                   color=color,
-                                   selected_color=selected_color,
-                                   var_color=variation_dic,
-                                   stock=quantity,
-                                   fav_status=fav_status,
-                                   fav_id=fav_id,
-                                   variations=variations
-                                   )
-        else:
-            fav_status = "NotAdded"
-            return render_template("product.html",
-                                   product_to_show=variation_product,
-                                   parent_product=parent_product,
-                                   color=color,
-                                   selected_color=selected_color,
-                                   var_color=variation_dic,
-                                   stock=quantity,
-                                   fav_status=fav_status,
-                                   )
-    else:
-        return render_template("product.html",
-                               product_to_show=variation_product,
-                               parent_product=parent_product,
-                               color=color,
-                               selected_color=selected_color,
-                               var_color=variation_dic,
-                               stock=quantity,
-                               )
+    return render_product_page(page_data)
 
 
 # # # # # # #  LOG IN / REGISTER / LOG OUT ROUTES  # # # # # # # #
@@ -1138,7 +1121,7 @@ def admin_login():
         admin = AdminUser.query.filter_by(email=email).first()
         if admin:
             password = request.form.get("password")
-            if check_password_hash(admin.password, password):
+            if check_login(admin, password):
                 login_user(admin)
                 return redirect(url_for("home"))
             else:
@@ -1155,7 +1138,7 @@ def login():
         user = User.query.filter_by(email=email).first()
         if user:
             password = request.form.get("password")
-            if check_password_hash(user.password, password):
+            if check_login(user, password):
                 login_user(user)
                 return redirect(url_for("home"))
             else:
@@ -1178,11 +1161,7 @@ def register():
                 password = request.form.get("password")
                 password_repeat = request.form.get("password-repeat")
                 if password == password_repeat:
-                    pw_hash = generate_password_hash(
-                        password=password,
-                        method="pbkdf2:sha256",
-                        salt_length=8
-                    )
+                    pw_hash = hash_password(password)
                     new_user = User(
                         name=request.form.get("name"),
                         surname=request.form.get("surname"),
@@ -1215,22 +1194,18 @@ def logout():
 # # # # # # # # # # # # # # # # # # # # # # ----ADMIN RELATED----  # # # # # # # # # # # # # # # # # # # # # #
 
 # # # # # # #  ADMIN ADD PRODUCT TO INVENTORY  # # # # # # # #
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+PRODUCT_TYPES = ["wooden", "fiberglass", "metal", "bamboo"]
 
 
-# To make each filename unique incase user uploads files with duplicate names.
-# Duplicate filenames cause problem when relocating the files, FileExists error.
-def make_unique(string):
-    uuid = uuid4().__str__()
-    return f"{uuid}-{string}"
+def image_slots(image_paths):
+    """main, second ... fifth image path of a product, "" for the missing ones"""
+    return (image_paths + [""] * 5)[:5]
 
 
 @app.route("/add_product", methods=["POST", "GET"])
 @login_required
 @admin_only
 def add_product():
-    global BASE_PATH
     if request.method == "POST":
         if 'img-files' not in request.files:
             flash('No file has been uploaded. Please upload images to continue.', "add_product_flash")
@@ -1265,57 +1240,26 @@ def add_product():
         product_identifier = request.form.get("identifier")
         variation_type = request.form.get("variation")
 
+        if product_identifier is None or secure_filename(product_identifier) != product_identifier:
+            flash(f"Product Identifier '{product_identifier}' can only have letters, numbers, '-' and '_'.",
+                  "add_product_flash")
+            return redirect(request.url)
+
         if variation_type == "Parent" or variation_type == "" or variation_type is None:
             variation_type = "Parent"
-            if product_type == "wooden":
-                BASE_PATH = f"static/images/wooden/" + product_identifier
-
-            if product_type == "fiberglass":
-                BASE_PATH = f"static/images/fiberglass/" + product_identifier
-
-            if product_type == "metal":
-                BASE_PATH = f"static/images/metal/" + product_identifier  # base path for new dir
-
-            if product_type == "bamboo":
-                BASE_PATH = f"static/images/bamboo/" + product_identifier
+            if product_type not in PRODUCT_TYPES:
+                flash("Please select the type of the product.", "add_product_flash")
+                return redirect(request.url)
 
-            new_dir = os.path.splitext(BASE_PATH)[0]  # removing extension before creating the new dir
-            if os.path.exists(new_dir):  # check if there's a directory with the same name
+            product_dir_path = f"static/images/{product_type}/{product_identifier}"
+            try:
+                # claims the directory, a product identifier that is already taken fails here
+                image_paths = publish_uploads(files, product_dir_path)
+            except FileExistsError:
                 flash(f"Product Identifier '{product_identifier}' is not unique. Please try another.",
                       "add_product_flash")
             else:
-                # USER PRODUCT INPUTS
-                os.mkdir(new_dir)  # creating new dir for that specific product identifier / "keep it out of loop"
-                product_dir_path = os.path.dirname(new_dir) + f"/{product_identifier}"  # catch new dir path
-                main_img = ""
-                second_img = ""
-                third_img = ""
-                fourth_img = ""
-                fifth_img = ""
-                for idx, file in enumerate(files):
-                    original_filename = secure_filename(file.filename)
-                    # make filenames unique incase user uploads files with duplicate names.
-                    # otherwise it will cause a FileExists error later when you relocate the images to new file.
-                    unique_filename = make_unique(original_filename)
-                    if idx == 0:
-                        main_img = product_dir_path + "/" + unique_filename
-                    if idx == 1:
-                        second_img = product_dir_path + "/" + unique_filename
-                    if idx == 2:
-                        third_img = product_dir_path + "/" + unique_filename
-                    if idx == 3:
-                        fourth_img = product_dir_path + "/" + unique_filename
-                    if idx == 4:
-                        fifth_img = product_dir_path + "/" + unique_filename
-                    filename = unique_filename  # get the filename for each uploaded file
-                    file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))  # save the uploaded files to folder
-                    uploaded_images = [f for f in os.listdir(UPLOAD_FOLDER)]
-                    for image in uploaded_images:
-                        if image.endswith('.jpg') or \
-                                image.endswith('.png') or \
-                                image.endswith('.jpeg') or \
-                                image.endswith('.PNG'):
-                            os.rename(f"static/images/{image}", f"{new_dir}/{image}")  # move img to new dir
+                main_img, second_img, third_img, fourth_img, fifth_img = image_slots(image_paths)
                 # Add product to db
                 new_product = Products(
                     product_identifier=product_identifier,
@@ -1338,10 +1282,16 @@ def add_product():
                 )
                 try:
                     db.session.add(new_product)
+                    db.session.flush()  # new_product.id is needed for its color rows
+                    index_product(new_product)
+                    invalidate_catalog()
                     db.session.commit()
+                    queue_derivatives(image_paths)
                     flash("Product has been added!", "add_product_flash")
                     return redirect(url_for("add_product"))
                 except sqlalchemy.exc.OperationalError:
+                    db.session.rollback()
+                    discard_uploads(product_dir_path)
                     flash("Somethings wrong, please try again in a few minutes.", "add_product_flash")
                     print("database is probably locked, check it")
                     return redirect(url_for("add_product"))
@@ -1350,40 +1300,20 @@ def add_product():
         elif variation_type == "Child":
             parent_product_identifier = request.form.get("parent_product_identifier")
             parent_product = Products.query.filter_by(product_identifier=parent_product_identifier).first()
+            if parent_product is None:
+                flash(f"There is no parent product '{parent_product_identifier}'.", "add_product_flash")
+                return redirect(request.url)
             parent_base_path = parent_product.file_path
 
             child_product_identifier = request.form.get("identifier")
             new_path_child = parent_base_path + "/" + child_product_identifier
-            os.mkdir(new_path_child)
-            main_img = ""
-            second_img = ""
-            third_img = ""
-            fourth_img = ""
-            fifth_img = ""
-            for idx, file in enumerate(files):
-                original_filename = secure_filename(file.filename)
-                # make filenames unique incase user uploads files with duplicate names.
-                # otherwise it will cause a FileExists error later when you relocate the images to new file.
-                unique_filename = make_unique(original_filename)
-                if idx == 0:
-                    main_img = new_path_child + "/" + unique_filename
-                if idx == 1:
-                    second_img = new_path_child + "/" + unique_filename
-                if idx == 2:
-                    third_img = new_path_child + "/" + unique_filename
-                if idx == 3:
-                    fourth_img = new_path_child + "/" + unique_filename
-                if idx == 4:
-                    fifth_img = new_path_child + "/" + unique_filename
-                filename = unique_filename  # get the filename for each uploaded file
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))  # save the uploaded files to folder
-                uploaded_images = [f for f in os.listdir(UPLOAD_FOLDER)]
-                for image in uploaded_images:
-                    if image.endswith('.jpg') or \
-                            image.endswith('.png') or \
-                            image.endswith('.jpeg') or \
-                            image.endswith('.PNG'):
-                        os.rename(f"static/images/{image}", f"{new_path_child}/{image}")  # move img to new dir
+            try:
+                image_paths = publish_uploads(files, new_path_child)
+            except FileExistsError:
+                flash(f"Product Identifier '{child_product_identifier}' is not unique. Please try another.",
+                      "add_product_flash")
+                return redirect(request.url)
+            main_img, second_img, third_img, fourth_img, fifth_img = image_slots(image_paths)
             # Add product to db
             new_product = VariationProducts(
                 product_identifier=child_product_identifier,
@@ -1408,6 +1338,8 @@ def add_product():
 
             try:
                 db.session.add(new_product)
+                db.session.flush()  # new_product.id is needed for its color rows
+                index_product(new_product)
                 parent_obj = Products.query.filter_by(product_identifier=parent_product.product_identifier).first()
                 parent_base = Products.query.filter_by(product_identifier=parent_product.product_identifier)
 
@@ -1425,10 +1357,14 @@ def add_product():
                     child_var_str = ''.join(str(child) for child in child_var_list)
                     parent_base.update({Products.child_variation_identifiers: child_var_str + " "})
 
+                invalidate_catalog()
                 db.session.commit()
+                queue_derivatives(image_paths)
                 flash("Product has been added!", "add_product_flash")
                 return redirect(url_for("add_product"))
             except sqlalchemy.exc.OperationalError:
+                db.session.rollback()
+                discard_uploads(new_path_child)
                 flash("Somethings wrong, please try again in a few minutes.", "add_product_flash")
                 print("database is probably locked, check it")
                 return redirect(url_for("add_product"))
@@ -1437,20 +1373,19 @@ def add_product():
 
 # # # # # # #  ADMIN INVENTORY ROUTES  # # # # # # # #
 @app.route("/admin/inventory/search_by_title/", methods=["GET", "POST"])
+@login_required
+@admin_only
 def search_inventory():
-    if request.method == "POST":
-        input_text = request.form.get("input_text")
-        parent_products = Products.query.all()
-        variation_products = VariationProducts.query.all()
-        combined = parent_products + variation_products
-
-        searched_list = []
-        for p in combined:
-            if input_text.lower() in p.title.lower():
-                searched_list.append(p)
-
-        return render_template("admin_inventory.html", products=searched_list)
-    return redirect(url_for("inventory"))
+    # first page comes from the search form (POST), next pages from the page links (GET)
+    input_text = request.values.get("input_text", "")
+    if not input_text.strip():
+        return redirect(url_for("inventory", filter_by="None"))
+    page = search_inventory_page(input_text, request.args.get("page"))
+    return render_template("admin_inventory.html",
+                           products=page.products,
+                           search_text=input_text,
+                           page=page.page,
+                           has_next=page.has_next)
 
 
 @app.route("/admin/inventory/filter/", methods=["GET", "POST"])
@@ -1463,75 +1398,12 @@ def inventory_filter():
 @login_required
 @admin_only
 def inventory(filter_by):
-    products_all = []
-    parent_products = Products.query.all()
-    variation_products = VariationProducts.query.all()
-
-    for item in parent_products:
-        products_all.append(item)
-    for item in variation_products:
-        products_all.append(item)
-
-    if filter_by == "None":
-        return render_template("admin_inventory.html", products=products_all)
-
-    if filter_by == "filter_price_desc":
-        for i in range(0, len(products_all)):
-            for j in range(i + 1, len(products_all)):
-                if products_all[i].price < products_all[j].price:
-                    temp = products_all[i]
-                    products_all[i] = products_all[j]
-                    products_all[j] = temp
-
-    if filter_by == "filter_price_asc":
-        for i in range(0, len(products_all)):
-            for j in range(i + 1, len(products_all)):
-                if products_all[i].price > products_all[j].price:
-                    temp = products_all[i]
-                    products_all[i] = products_all[j]
-                    products_all[j] = temp
-
-    if filter_by == "filter_stock_desc":
-        for i in range(0, len(products_all)):
-            for j in range(i + 1, len(products_all)):
-                if products_all[i].stock < products_all[j].stock:
-                    temp = products_all[i]
-                    products_all[i] = products_all[j]
-                    products_all[j] = temp
-
-    if filter_by == "filter_stock_asc":
-        for i in range(0, len(products_all)):
-            for j in range(i + 1, len(products_all)):
-                if products_all[i].stock > products_all[j].stock:
-                    temp = products_all[i]
-                    products_all[i] = products_all[j]
-                    products_all[j] = temp
-
-    if filter_by == "filter_identifier":
-        assign_dict = {}
-        for p in products_all:
-            assign_dict[p] = p.product_identifier
-
-        sorted_dict = dict(sorted(assign_dict.items(), key=lambda p_item: p_item[1]))
-        products_all.clear()
-
-        for key, value in sorted_dict.items():
-            products_all.append(key)
-
-        return render_template("admin_inventory.html", products=products_all)
-
-    if filter_by == "filter_category":
-        assign_dict = {}
-        for p in products_all:
-            assign_dict[p] = p.product_type
-
-        sorted_dict = dict(sorted(assign_dict.items(), key=lambda p_item: p_item[1]))
-        products_all.clear()
-
-        for key, value in sorted_dict.items():
-            products_all.append(key)
-
-    return render_template("admin_inventory.html", products=products_all)
+    page = inventory_page(filter_by, request.args.get("page"))
+    return render_template("admin_inventory.html",
+                           products=page.products,
+                           filter_by=filter_by,
+                           page=page.page,
+                           has_next=page.has_next)
 
 
 @app.route("/admin/inventory/update", methods=["GET", "POST"])
@@ -1547,35 +1419,18 @@ def update_inventory():
             current_product = VariationProducts.query.filter_by(id=product_id,
                                                                 product_identifier=product_identifier).first()
 
-        carts = UserCart.query.all()
-        favs = UserFav.query.all()
-
         action = request.form.get("action")
         if action == "update_price_stock":
             price = request.form.get("price")
             stock = request.form.get("stock")
             if price:
-                # change current product price
+                # change current product price, and the price on all carts and favourites
                 current_product.price = float(price)
-
-                # change the price on all carts
-                for item in carts:
-                    if item.product_id == current_product.id and\
-                            item.product_identifier == current_product.product_identifier:
-                        item.price = float(price)
-                        item.total_price = item.quantity * float(price)
-
-                # change the price on all favourites
-                for item in favs:
-                    if item.product_id == current_product.id and\
-                            item.product_identifier == current_product.product_identifier:
-                        item.price = float(price)
-                        item.total_price = item.quantity * float(price)
-
-                db.session.commit()
+                update_carts_and_favs(current_product, price=float(price))
             if stock:
                 current_product.stock = int(stock)
-                db.session.commit()
+            invalidate_catalog()
+            db.session.commit()
 
             return redirect(url_for("inventory", filter_by="None"))
 
@@ -1589,17 +1444,7 @@ def update_inventory():
             if new_title != "":
                 current_product.title = new_title
                 # change the title on all carts and favourites
-                for item in carts:
-                    if item.product_id == current_product.id and \
-                            item.product_identifier == current_product.product_identifier:
-                        item.title = new_title
-
-                for item in favs:
-                    if item.product_id == current_product.id and \
-                            item.product_identifier == current_product.product_identifier:
-                        if item.product_id == current_product.id and \
-                                item.product_identifier == current_product.product_identifier:
-                            item.title = new_title
+                update_carts_and_favs(current_product, title=new_title)
 
             # description1
             if new_descr1 != "":
@@ -1613,16 +1458,20 @@ def update_inventory():
             if new_descr3 != "":
                 current_product.description3 = new_descr3
 
+            index_product(current_product)
+            invalidate_catalog()
             db.session.commit()
             return redirect(url_for("inventory", filter_by="None"))
 
         elif action == "delete":
             if Products.query.filter_by(id=product_id, product_identifier=product_identifier).first() is not None:
                 Products.query.filter_by(id=product_id, product_identifier=product_identifier).delete()
-                db.session.commit()
+                unindex_product(product_id, is_variation=False)
             else:
                 VariationProducts.query.filter_by(id=product_id, product_identifier=product_identifier).delete()
-                db.session.commit()
+                unindex_product(product_id, is_variation=True)
+            invalidate_catalog()
+            db.session.commit()
 
     return redirect(url_for("inventory", filter_by="None"))
 
@@ -1700,6 +1549,10 @@ def create_shipment(order_number, order_detail_id, user_id):
         current_order_detail = OrderDetails.query.filter_by(order_number=order_number,
                                                             id=order_detail_id,
                                                             user_id=user_id).first()
+        if current_order_detail is None:
+            abort(404)
+        if current_order_detail.order_status in (STATUS_PAYMENT_PENDING, STATUS_PAYMENT_FAILED):
+            abort(409)  # not paid, and finalize_order / fail_order would overwrite the shipment
 
         current_order = Orders.query.filter_by(order_number=order_number, user_id=user_id).first()
         current_order_detail_list = OrderDetails.query.filter_by(order_number=order_number,
@@ -1716,6 +1569,7 @@ def create_shipment(order_number, order_detail_id, user_id):
         current_tracking.update({TrackingInformation.shipment_status: status})
 
         current_order_detail.order_status = status
+        notify_order_status(current_order_detail, f"{status}, {company} tracking number {tracking_number}")
 
         status_all = []
         for detail in current_order_detail_list:
@@ -1771,6 +1625,8 @@ def handle_return_request(action, order_number, order_detail_id, user_id):
 
             current_order_detail.order_status = f"Accepted {shipment_number} {company}"
             current_return.approve = f"Accepted {shipment_number} {company}"
+            notify_order_status(current_order_detail,
+                                f"Return accepted, send it with {company} shipment number {shipment_number}")
             db.session.commit()
 
         elif action == "Deny":
@@ -1778,6 +1634,7 @@ def handle_return_request(action, order_number, order_detail_id, user_id):
 
             current_order_detail.order_status = f"Deny {reason}"
             current_return.approve = f"Deny {reason}"
+            notify_order_status(current_order_detail, f"Return denied: {reason}")
             db.session.commit()
         return redirect(request.referrer)
 
@@ -1789,4 +1646,8 @@ def admin_cancelled_orders():
 
 
 if __name__ == "__main__":
-    app.run(port=5000, debug=True, host="localhost")
+    # development server only, see wsgi.py for production. Run with `dotenv run -- python main.py` to read .env
+    create_app()
+    with app.app_context():
+        create_schema()
+    app.run(port=5000, debug=os.getenv("FLASK_DEBUG") == "1", host="localhost")
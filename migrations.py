@@ -0,0 +1,230 @@
+"""Versioned schema changes for databases that already exist. Migrations are frozen: never edit one that has
+shipped, add a new one.
+    dotenv run -- python migrations.py
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+
+MIGRATIONS = []
+
+
+def migration(version, description, dialects=None):
+    """Register a migration. One that names its `dialects` is only run on those databases, on any other it is
+    recorded as applied without running."""
+    def register(func):
+        MIGRATIONS.append((version, description, func, dialects))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+
+def _create_version_table(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, description VARCHAR NOT NULL, applied_at VARCHAR NOT NULL)"
+    ))
+
+
+def applied_versions(engine):
+    with engine.begin() as connection:
+        _create_version_table(connection)
+        return {row.version for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def upgrade(engine):
+    """Apply every migration that is not applied yet, oldest first. Returns the applied versions."""
+    done = applied_versions(engine)
+    applied = []
+    for version, description, func, dialects in MIGRATIONS:
+        if version in done:
+            continue
+        try:
+            with engine.begin() as connection:
+                if dialects is None or connection.dialect.name in dialects:
+                    func(connection)
+                connection.execute(text(
+                    "INSERT INTO schema_migrations (version, description, applied_at) "
+                    "VALUES (:version, :description, :applied_at)"
+                ), {"version": version, "description": description, "applied_at": datetime.now().isoformat()})
+            applied.append(version)
+        except IntegrityError:
+            pass  # another worker applied it at the same time, its transaction won
+    return applied
+
+
+def _add_column(connection, table, column, definition):
+    """ALTER TABLE ADD COLUMN, unless create_all already made the table with the column"""
+    if column not in {c["name"] for c in inspect(connection).get_columns(table)}:
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+
+
+def _create_indexes(connection, indexes):
+    for name, table, columns in indexes:
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+
+# # # # # # # #  MIGRATIONS  # # # # # # # #
+# helpers shared by the sqlite and postgresql versions of a migration, they must keep doing exactly what they do
+SEARCH_COLUMNS = "title, description1, description2, description3, color, product_identifier"
+
+
+def _create_sort_indexes(connection):
+    _create_indexes(connection, [
+        ("ix_products_price", "products", ["price", "id"]),
+        ("ix_products_stock", "products", ["stock", "id"]),
+        ("ix_products_product_identifier", "products", ["product_identifier", "id"]),
+        ("ix_products_product_type", "products", ["product_type", "id"]),
+        ("ix_variation_products_price", "variation_products", ["price", "id"]),
+        ("ix_variation_products_stock", "variation_products", ["stock", "id"]),
+        ("ix_variation_products_product_identifier", "variation_products", ["product_identifier", "id"]),
+        ("ix_variation_products_product_type", "variation_products", ["product_type", "id"]),
+    ])
+
+
+def _backfill_catalog(connection):
+    """Fill product_search and product_colors from both product tables"""
+    connection.execute(text("DELETE FROM product_search"))
+    connection.execute(text("DELETE FROM product_colors"))
+    for table, is_variation in [("products", 0), ("variation_products", 1)]:
+        connection.execute(text(
+            f"INSERT INTO product_search ({SEARCH_COLUMNS}, product_id, is_variation) "
+            f"SELECT title, coalesce(description1, ''), coalesce(description2, ''), coalesce(description3, ''), "
+            f"color, product_identifier, id, {is_variation} FROM {table}"
+        ))
+        for row in connection.execute(text(f"SELECT id, product_identifier, color FROM {table}")).all():
+            for word in sorted({word.lower() for word in row.color.split() if word.isalnum()}):
+                connection.execute(text(
+                    "INSERT INTO product_colors (product_id, product_identifier, is_variation, color) "
+                    "VALUES (:product_id, :product_identifier, :is_variation, :color)"
+                ), {"product_id": row.id, "product_identifier": row.product_identifier,
+                    "is_variation": bool(is_variation), "color": word})
+
+
+@migration(1, "product sort indexes, product_search fts table, backfill product_colors and product_search",
+           dialects=("sqlite",))
+def _catalog_indexes(connection):
+    _create_sort_indexes(connection)
+    connection.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5({SEARCH_COLUMNS}, "
+        f"product_id UNINDEXED, is_variation UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+    ))
+    _backfill_catalog(connection)
+
+
+@migration(2, "indexes for user, order number and product identifier lookups")
+def _lookup_indexes(connection):
+    _create_indexes(connection, [
+        ("ix_user_addresses_user_id", "user_addresses", ["user_id"]),
+        ("ix_user_billing_addresses_user_id", "user_billing_addresses", ["user_id"]),
+        ("ix_cart_user_id", "cart", ["user_id", "product_identifier"]),
+        ("ix_cart_product", "cart", ["product_id", "product_identifier"]),
+        ("ix_favourites_user_id", "favourites", ["user_id", "product_id", "product_identifier"]),
+        ("ix_favourites_product", "favourites", ["product_id", "product_identifier"]),
+        ("ix_orders_user_id", "orders", ["user_id"]),
+        ("ix_orders_order_number_user_id", "orders", ["order_number", "user_id"]),
+        ("ix_order_details_user_id", "order_details", ["user_id"]),
+        ("ix_order_details_order_number_user_id", "order_details", ["order_number", "user_id", "id"]),
+        ("ix_tracking_information_user_id", "tracking_information", ["user_id"]),
+        ("ix_tracking_information_order", "tracking_information", ["order_number", "order_detail_id", "user_id"]),
+        ("ix_returns_user_id", "returns", ["user_id"]),
+        ("ix_returns_order", "returns", ["order_number", "order_detail_id", "user_id"]),
+        ("ix_cancelled_orders_user_id", "cancelled_orders", ["user_id"]),
+        ("ix_variation_products_parent", "variation_products", ["parent_product_identifier"]),
+    ])
+
+
+@migration(3, "stripe customer id of users")
+def _stripe_customer_id(connection):
+    _add_column(connection, "users", "stripe_customer_id", "VARCHAR")
+
+
+@migration(4, "drop the card tokens of finished checkout events")
+def _forget_checkout_tokens(connection):
+    rows = connection.execute(text(
+        "SELECT id, payload FROM stripe_events WHERE type = 'checkout.requested' AND status IN ('done', 'failed')"
+    )).all()
+    for row in rows:
+        payload = json.loads(row.payload)
+        if payload["data"]["object"].pop("token", None) is not None:
+            connection.execute(text("UPDATE stripe_events SET payload = :payload WHERE id = :id"),
+                               {"payload": json.dumps(payload), "id": row.id})
+
+
+def _create_postgres_search_table(connection):
+    """product_search on PostgreSQL: the same columns as the sqlite fts5 table, plus a weighted tsvector
+    kept up to date by postgres itself (generated column, PostgreSQL 12+) and its GIN index"""
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS product_search ("
+        "title VARCHAR, description1 VARCHAR, description2 VARCHAR, description3 VARCHAR, color VARCHAR, "
+        "product_identifier VARCHAR, product_id INTEGER NOT NULL, is_variation INTEGER NOT NULL, "
+        "document tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce(product_identifier, '')), 'B') || "
+        "setweight(to_tsvector('simple', coalesce(color, '')), 'C') || "
+        "setweight(to_tsvector('simple', coalesce(description1, '') || ' ' || coalesce(description2, '') "
+        "|| ' ' || coalesce(description3, '')), 'D')) STORED)"
+    ))
+    _create_indexes(connection, [("ix_product_search_product", "product_search", ["product_id", "is_variation"])])
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_product_search_document ON product_search USING GIN (document)"
+    ))
+
+
+@migration(5, "product sort indexes, product_search tsvector table, backfill product_colors and product_search "
+              "(postgresql)", dialects=("postgresql",))
+def _postgres_catalog_indexes(connection):
+    """What migration 1 does on sqlite"""
+    _create_sort_indexes(connection)
+    _create_postgres_search_table(connection)
+    _backfill_catalog(connection)
+
+
+MONEY_COLUMNS = {
+    "cart": ["price", "total_price"],
+    "orders": ["total_order_value"],
+    "order_details": ["price", "total_price"],
+    "cancelled_orders": ["price", "refunded_amount"],
+    "favourites": ["price", "total_price"],
+    "products": ["price"],
+    "variation_products": ["price"],
+}
+ORDER_NUMBER_TABLES = ["orders", "order_details", "cancelled_orders", "tracking_information", "returns",
+                       "order_notifications"]
+
+
+@migration(6, "money columns as double precision, order numbers as bigint (postgresql)", dialects=("postgresql",))
+def _postgres_column_types(connection):
+    """The models declared money as Integer, which postgres rounds, and order numbers no longer fit 32 bits.
+    sqlite keeps whatever value it is given whatever the declared type, so it needs nothing."""
+    for table, columns in MONEY_COLUMNS.items():
+        for column in columns:
+            connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE DOUBLE PRECISION"))
+    for table in ORDER_NUMBER_TABLES:
+        connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN order_number TYPE BIGINT"))
+
+
+@migration(7, "shared catalog cache version")
+def _catalog_version_row(connection):
+    connection.execute(text(
+        "INSERT INTO cache_versions (name, version) "
+        "SELECT 'catalog', 0 WHERE NOT EXISTS (SELECT 1 FROM cache_versions WHERE name = 'catalog')"
+    ))
+
+
+@migration(8, "shared principal cache version")
+def _principals_version_row(connection):
+    connection.execute(text(
+        "INSERT INTO cache_versions (name, version) "
+        "SELECT 'principals', 0 WHERE NOT EXISTS (SELECT 1 FROM cache_versions WHERE name = 'principals')"
+    ))
+
+
+if __name__ == "__main__":
+    from db_app import db, init_extensions, create_schema
+
+    with init_extensions().app_context():
+        create_schema()
+        print("applied migrations:", sorted(applied_versions(db.engine)))
@@ -1,81 +1,161 @@
-from db_app import db, Orders, TrackingInformation, UserAddresses, UserBillingAddresses, OrderDetails, Products,\
+from sqlalchemy import bindparam, select
+
+from db_app import db, TrackingInformation, UserAddresses, UserBillingAddresses, Orders, OrderDetails, Products,\
     VariationProducts
+from product_related_functions import invalidate_catalog
+
+# an order is created as "Payment Pending" and moves to "Being Prepared" or "Payment Failed" once, see finalize_order
+STATUS_PAYMENT_PENDING = "Payment Pending"
+STATUS_PAYMENT_FAILED = "Payment Failed"
+STATUS_BEING_PREPARED = "Being Prepared"
+
 
+def address_text(address):
+    return address.address_line + " " + address.city + " " + address.state + " " \
+           + address.postal_code + " " + address.country
 
-def create_order_tracking(order_number, order_detail_id, user_id):
+
+def create_order_tracking(order_detail, user_delivery, user_billing):
     """Temporary tracking information for orders just being processed"""
-    status_being_prepared = "Being Prepared"
-    # # # for delivery address info:
-    current_order = Orders.query.filter_by(order_number=order_number, user_id=user_id).first()
-
-    delivery_id = current_order.delivery_address_ids
-    billing_id = current_order.billing_address_ids
-
-    user_delivery = UserAddresses.query.filter_by(id=delivery_id, user_id=user_id).first()
-    user_billing = UserBillingAddresses.query.filter_by(id=billing_id, user_id=user_id).first()
-
-    delivery_address = user_delivery.address_line + " " + user_delivery.city + " " + user_delivery.state + " " \
-                       + user_delivery.postal_code + " " + user_delivery.country
-    billing_address = user_billing.address_line + " " + user_billing.city + " " + user_billing.state + " " \
-                      + user_billing.postal_code + " " + user_billing.country
-    # # #
-
-    current_tracking = TrackingInformation.query.filter_by(order_number=order_number,
-                                                           order_detail_id=order_detail_id,
-                                                           user_id=user_id).first()
-    order_detail = OrderDetails.query.filter_by(id=order_detail_id, order_number=order_number, user_id=user_id).first()
-
-    # if there are no current tracking information for this product, make it Being Prepared and add to db:
-    if current_tracking is None:
-        update_tracking = TrackingInformation(
-            order_number=order_number,
-            order_detail_id=order_detail_id,
-            tracking_number="Will be added",
-            shipping_company="Will be added",
-            expected_delivery_date="Will be added",
-            shipment_status=status_being_prepared,
-            receiver_name=user_delivery.name + " " + user_delivery.surname,
-            receiver_contact_number=user_delivery.phone_number_ext + " " + user_delivery.phone_number,
-            delivery_address=delivery_address,
-            billing_address=billing_address,
-            user_id=user_id
+    return TrackingInformation(
+        order_number=order_detail.order_number,
+        order_detail_id=order_detail.id,
+        tracking_number="Will be added",
+        shipping_company="Will be added",
+        expected_delivery_date="Will be added",
+        shipment_status=STATUS_BEING_PREPARED,
+        receiver_name=user_delivery.name + " " + user_delivery.surname,
+        receiver_contact_number=user_delivery.phone_number_ext + " " + user_delivery.phone_number,
+        delivery_address=address_text(user_delivery),
+        billing_address=address_text(user_billing),
+        user_id=order_detail.user_id
+    )
+
+
+def _product_tables(cart_items):
+    """The table (Products or VariationProducts) of every cart line, None for products that no longer exist.
+    One select per table for the whole cart."""
+    lines = {(item.product_id, item.product_identifier) for item in cart_items}
+    tables = {}
+    for model in (Products, VariationProducts):
+        table = model.__table__
+        rows = db.session.execute(select(table.c.id, table.c.product_identifier)
+                                  .where(table.c.id.in_({product_id for product_id, _ in lines}))).all()
+        tables.update({tuple(row): table for row in rows if tuple(row) in lines})
+    return [tables.get((item.product_id, item.product_identifier)) for item in cart_items]
+
+
+def reserve_stock(cart_items):
+    """Take all cart lines out of stock in one transaction, or none of them. Returns the lines that could not be
+    reserved."""
+    failed = []
+    # always lock the rows in the same order, two carts with the same products can't wait for each other
+    lines = sorted(zip(cart_items, _product_tables(cart_items)),
+                   key=lambda line: (line[1].name if line[1] is not None else "", line[0].product_id))
+    for item, table in lines:
+        if table is None:
+            failed.append(item)
+            continue
+        result = db.session.execute(
+            table.update()
+            .where(table.c.id == item.product_id,
+                   table.c.product_identifier == item.product_identifier,
+                   table.c.stock >= item.quantity)
+            .values(stock=table.c.stock - item.quantity)
         )
-        db.session.add(update_tracking)
-        # change order status on order detail db
-        order_detail.order_status = status_being_prepared
+        if result.rowcount != 1:
+            failed.append(item)
+    failed = [item for item in cart_items if item in failed]  # in cart order
+
+    if failed:
+        db.session.rollback()
+    else:
+        # stock has changed, storefront listings must not keep showing the old values
+        invalidate_catalog()
         db.session.commit()
+    return failed
+
 
+def _return_stock(items):
+    lines = [{"p_id": item.product_id, "p_identifier": item.product_identifier, "quantity": item.quantity}
+             for item in items]
+    for model in (Products, VariationProducts):
+        table = model.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.id == bindparam("p_id"), table.c.product_identifier == bindparam("p_identifier"))
+            .values(stock=table.c.stock + bindparam("quantity")),
+            lines
+        )
+
+
+def release_stock(cart_items):
+    """Put the quantities taken by reserve_stock back, when the order could not be placed"""
+    db.session.rollback()  # whatever failed during the checkout must not be committed along with this
+    _return_stock(cart_items)
+    invalidate_catalog()
+    db.session.commit()
 
-def add_order_details(cart_items, order_number, user_id):
-    current_order = Orders.query.filter_by(order_number=order_number, user_id=user_id).first()
-    for item in cart_items:
-        order_details = OrderDetails(
-            order_number=order_number,
+
+def add_order_details(cart_items, order, user_id):
+    """Save a new "Payment Pending" order and its details in one transaction, stock is already reserved"""
+    db.session.flush()  # order.id
+
+    order_details = [
+        OrderDetails(
+            order_number=order.order_number,
             product_id=item.product_id,
-            order_id=current_order.id,
+            order_id=order.id,
             product_identifier=item.product_identifier,
             title=item.title,
             color=item.color,
             price=item.price,
             quantity=item.quantity,
             total_price=item.total_price,
-            order_status="Being Prepared",
+            order_status=STATUS_PAYMENT_PENDING,
             returned_quantity=0,
             main_img_path=item.main_img_path,
             user_id=user_id
         )
-        db.session.add(order_details)
-        # UserCart.query.filter_by(user_id=current_user.id).delete()
-        db.session.commit()
+        for item in cart_items
+    ]
+    db.session.bulk_save_objects(order_details)  # one executemany, the new ids are not needed here
+    db.session.commit()
 
-        # create order tracking for each item purchased
-        create_order_tracking(order_number, order_detail_id=order_details.id, user_id=user_id)
 
-        # subtract purchased quantity from product stock
-        current_product = Products.query.filter_by(id=item.product_id,
-                                                   product_identifier=item.product_identifier).first()
-        if current_product is None:
-            current_product = VariationProducts.query.filter_by(id=item.product_id,
-                                                                product_identifier=item.product_identifier).first()
-        current_product.stock -= item.quantity
-        db.session.commit()
+def _settle_order(order_number, payment_status, status):
+    """Move a "Payment Pending" order and its details to `status`. Returns the order, or None if the order was
+    already settled: the payment worker and the stripe webhook may both report the same payment."""
+    result = Orders.query.filter_by(order_number=order_number, payment_status=STATUS_PAYMENT_PENDING)\
+        .update({Orders.payment_status: payment_status, Orders.shipment_status: status},
+                synchronize_session=False)
+    if result != 1:
+        return None
+    order = Orders.query.filter_by(order_number=order_number).first()
+    OrderDetails.query.filter_by(order_id=order.id).update({OrderDetails.order_status: status},
+                                                          synchronize_session=False)
+    return order
+
+
+def finalize_order(order_number, payment_status):
+    """Paid: prepare the order for shipment with its tracking information. False if it was already settled."""
+    order = _settle_order(order_number, payment_status, STATUS_BEING_PREPARED)
+    if order is None:
+        return False
+    user_delivery = UserAddresses.query.filter_by(id=order.delivery_address_ids, user_id=order.user_id).first()
+    user_billing = UserBillingAddresses.query.filter_by(id=order.billing_address_ids, user_id=order.user_id).first()
+    order_details = OrderDetails.query.filter_by(order_id=order.id).all()
+    # create order tracking for each item purchased, in one executemany
+    db.session.bulk_save_objects([create_order_tracking(detail, user_delivery, user_billing)
+                                  for detail in order_details])
+    return True
+
+
+def fail_order(order_number):
+    """Not paid: mark the order failed and put its stock back. False if it was already settled."""
+    order = _settle_order(order_number, STATUS_PAYMENT_FAILED, STATUS_PAYMENT_FAILED)
+    if order is None:
+        return False
+    _return_stock(OrderDetails.query.filter_by(order_id=order.id).all())
+    invalidate_catalog()
+    return True
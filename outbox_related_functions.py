@@ -0,0 +1,77 @@
+"""Background workers of the queue tables (email_outbox, stripe_events)"""
+import logging
+import threading
+import time
+
+from db_app import app, db
+
+
+class OutboxWorker:
+    """Claiming, retrying and the worker thread of one queue table"""
+
+    def __init__(self, model, name, busy_status, batch_size, max_attempts, backoff_seconds, claim_timeout_seconds,
+                 poll_seconds, order_by):
+        self.model = model
+        self.name = name
+        self.busy_status = busy_status
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.claim_timeout_seconds = claim_timeout_seconds
+        self.poll_seconds = poll_seconds
+        self.order_by = order_by
+        self._wake = threading.Event()
+        self._thread = None
+
+    def claim_due(self):
+        """Mark up to batch_size due rows as busy_status. A row is only claimed if no other worker claimed it first."""
+        model = self.model
+        now = time.time()
+        due = model.query.filter(model.status.in_(["pending", self.busy_status]), model.next_attempt_at <= now)\
+            .order_by(self.order_by).limit(self.batch_size).all()
+        claimed = []
+        for row in due:
+            result = model.query.filter_by(id=row.id, status=row.status, next_attempt_at=row.next_attempt_at)\
+                .update({model.status: self.busy_status, model.next_attempt_at: now + self.claim_timeout_seconds},
+                        synchronize_session=False)
+            if result == 1:
+                claimed.append(row.id)
+        db.session.commit()
+        return model.query.filter(model.id.in_(claimed)).order_by(self.order_by).all() if claimed else []
+
+    def retry_later(self, row, error):
+        """Count a failed attempt of `row`, True if it was given up on"""
+        row.attempts += 1
+        row.last_error = f"{type(error).__name__}: {error}"
+        if row.attempts >= self.max_attempts:
+            row.status = "failed"
+            return True
+        row.status = "pending"
+        row.next_attempt_at = time.time() + self.backoff_seconds * 2 ** (row.attempts - 1)
+        return False
+
+    def wake(self):
+        """Don't wait for the next poll, a row was just added"""
+        self._wake.set()
+
+    def run(self, process_batch, stop=None, idle=None):
+        """Call `process_batch` (returns how many rows it took) until `stop` (a threading.Event) is set.
+        When the queue is drained `idle` is called, then the worker waits for wake() or poll_seconds."""
+        while stop is None or not stop.is_set():
+            try:
+                with app.app_context():
+                    processed = process_batch()
+            except Exception:
+                logging.exception(f"{self.name} failed, trying again")
+                processed = 0
+            if processed < self.batch_size:
+                if idle is not None:
+                    idle()
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+    def start(self, target):
+        """Start the worker thread of this process running `target`, once"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=target, name=self.name, daemon=True)
+            self._thread.start()
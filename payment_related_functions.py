@@ -0,0 +1,239 @@
+"""Stripe calls of the checkout, and the consumer of the saved webhook and checkout events. Run it on its own with:
+    dotenv run -- python payment_related_functions.py
+"""
+import json
+import logging
+import time
+
+import requests
+import stripe
+from sqlalchemy.exc import IntegrityError
+
+from db_app import db, init_extensions, StripeEvents, Orders, User, STRIPE_CONNECT_TIMEOUT, STRIPE_READ_TIMEOUT
+from order_related_functions import finalize_order, fail_order, STATUS_PAYMENT_PENDING
+from outbox_related_functions import OutboxWorker
+
+EVENT_BATCH_SIZE = 50
+EVENT_MAX_ATTEMPTS = 8
+EVENT_RETRY_BACKOFF_SECONDS = 10  # 10s, 20s, 40s ... about 20 minutes in total
+EVENT_PROCESSING_TIMEOUT_SECONDS = 300
+EVENT_POLL_SECONDS = 5
+
+EVENT_HANDLERS = {}
+
+event_worker = OutboxWorker(StripeEvents, "stripe-events", busy_status="processing", batch_size=EVENT_BATCH_SIZE,
+                            max_attempts=EVENT_MAX_ATTEMPTS, backoff_seconds=EVENT_RETRY_BACKOFF_SECONDS,
+                            claim_timeout_seconds=EVENT_PROCESSING_TIMEOUT_SECONDS, poll_seconds=EVENT_POLL_SECONDS,
+                            order_by=StripeEvents.id)
+
+_session = requests.Session()
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16))
+_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16))
+stripe.default_http_client = stripe.RequestsClient(timeout=(STRIPE_CONNECT_TIMEOUT, STRIPE_READ_TIMEOUT),
+                                                   session=_session)
+
+
+class ChargedError(Exception):
+    """The card was charged, but the order could not be settled"""
+
+    def __init__(self, payment_id, error):
+        super().__init__(f"{payment_id} charged, {type(error).__name__}: {error}")
+        self.payment_id = payment_id
+
+
+def _new_customer(user, idempotency_key):
+    customer = stripe.Customer.create(
+        email=user.email,
+        name=user.name + " " + user.surname,
+        metadata={"user_id": user.id},
+        idempotency_key=f"{idempotency_key}-customer",
+    )
+    user.stripe_customer_id = customer.id
+    # flushed only: committed with the rest of the handler, a retry gets the same customer by its idempotency key
+    db.session.flush()
+    return customer.id
+
+
+def _pay(customer_id, token, amount_cents, idempotency_key, metadata, description):
+    return stripe.PaymentIntent.create(
+        customer=customer_id,
+        payment_method_data={"type": "card", "card": {"token": token}},
+        payment_method_types=["card"],
+        confirm=True,
+        amount=amount_cents,
+        currency="usd",
+        description=description,
+        metadata=metadata,
+        idempotency_key=idempotency_key,
+    )
+
+
+def charge_user(user, token, amount_cents, idempotency_key, metadata=None, description="Purchase Payment"):
+    """Charge a checkout token to the user's Stripe customer. Calling it again with the same `idempotency_key`
+    returns the first result."""
+    if user.stripe_customer_id is None:
+        _new_customer(user, idempotency_key)
+    # the card is only used for this payment, it is not saved on the customer
+    try:
+        return _pay(user.stripe_customer_id, token, amount_cents, f"{idempotency_key}-payment", metadata or {},
+                    description)
+    except stripe.error.InvalidRequestError as ex:
+        if ex.code != "resource_missing" or ex.param != "customer":
+            raise
+        # the customer was deleted on the Stripe dashboard
+        _new_customer(user, f"{idempotency_key}-renewed")
+        return _pay(user.stripe_customer_id, token, amount_cents, f"{idempotency_key}-renewed-payment",
+                    metadata or {}, description)
+
+
+# # # # # # # #  WEBHOOK EVENTS  # # # # # # # #
+def event_handler(*event_types):
+    """Register a function(event) to process stripe events of the given types"""
+    def register(func):
+        for event_type in event_types:
+            EVENT_HANDLERS[event_type] = func
+        return func
+    return register
+
+
+@event_handler("checkout.requested")
+def _charge_order(event):
+    checkout = event["data"]["object"]
+    order_number = checkout["order_number"]
+    order = Orders.query.filter_by(order_number=order_number).first()
+    if order is None or order.payment_status != STATUS_PAYMENT_PENDING:
+        return
+    if "payment_id" in checkout:
+        # charged by an earlier attempt that could not settle the order
+        finalize_order(order_number, "succeeded")
+        return
+    try:
+        payment = charge_user(User.query.get(order.user_id), checkout["token"], checkout["amount"],
+                             idempotency_key=f"order-{order_number}",
+                             metadata={"order_number": order_number})
+    except (stripe.error.CardError, stripe.error.InvalidRequestError) as ex:
+        logging.error(f"Payment of order {order_number} failed: {ex.user_message}")
+        fail_order(order_number)
+        return
+    # connection errors and timeouts are raised, the event is retried with the same idempotency key
+
+    if payment.status == "succeeded":
+        try:
+            finalize_order(order_number, payment.status)
+        except Exception as ex:
+            raise ChargedError(payment.id, ex) from ex
+    elif payment.status != "processing":
+        fail_order(order_number)  # declined, or a card that needs an authentication a token can't give
+    # "processing": settled by the payment_intent.succeeded / payment_intent.payment_failed webhook
+
+
+@event_handler("charge.succeeded", "charge.failed", "payment_intent.succeeded", "payment_intent.payment_failed")
+def _settle_payment(event):
+    payment = event["data"]["object"]
+    order_number = (payment.get("metadata") or {}).get("order_number")
+    if order_number is None:
+        return
+    if event["type"].endswith(".succeeded"):
+        finalize_order(int(order_number), "succeeded")
+    else:
+        fail_order(int(order_number))
+
+
+def _event_row(event_id, event_type, payload):
+    now = time.time()
+    return StripeEvents(
+        event_id=event_id,
+        type=event_type,
+        payload=payload,
+        status="pending",
+        attempts=0,
+        next_attempt_at=now,
+        received_at=now,
+    )
+
+
+def queue_checkout(order, token, amount_cents):
+    """Queue the payment of a new "Payment Pending" order, call wake_event_consumer() after the commit"""
+    event_id = f"checkout_{order.order_number}"
+    db.session.add(_event_row(event_id, "checkout.requested", json.dumps({
+        "id": event_id,
+        "type": "checkout.requested",
+        "data": {"object": {"order_number": order.order_number, "token": token, "amount": amount_cents}},
+    })))
+
+
+def _forget_card_token(event):
+    """Drop the card token of a checkout event that is done or given up on, it is only needed to charge"""
+    if event.type == "checkout.requested":
+        payload = json.loads(event.payload)
+        if payload["data"]["object"].pop("token", None) is not None:
+            event.payload = json.dumps(payload)
+
+
+def _save_payment_id(event, payment_id):
+    """Keep the payment of a checkout event, its retries settle the order without charging again"""
+    payload = json.loads(event.payload)
+    payload["data"]["object"]["payment_id"] = payment_id
+    event.payload = json.dumps(payload)
+
+
+def wake_event_consumer():
+    event_worker.wake()
+
+
+def save_stripe_event(event, payload):
+    """Save a verified webhook event and its json `payload` for the consumer.
+    Returns False if the event id was already saved."""
+    db.session.add(_event_row(event["id"], event["type"],
+                              payload.decode() if isinstance(payload, bytes) else payload))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    event_worker.wake()
+    return True
+
+
+def process_due_events():
+    """Run the handlers of one batch of saved events. Returns how many events were taken."""
+    events = event_worker.claim_due()
+    for event in events:
+        event_id = event.id
+        handler = EVENT_HANDLERS.get(event.type)
+        try:
+            if handler is not None:
+                handler(json.loads(event.payload))
+            event.status = "done"
+            event.last_error = None
+            _forget_card_token(event)
+            db.session.commit()
+        except Exception as ex:
+            db.session.rollback()  # drop whatever the handler changed, it runs again on the next attempt
+            event = StripeEvents.query.get(event_id)
+            if isinstance(ex, ChargedError):
+                _save_payment_id(event, ex.payment_id)
+            if event_worker.retry_later(event, ex):
+                logging.error(f"Giving up on stripe event {event.event_id}: {event.last_error}")
+                checkout = json.loads(event.payload)["data"]["object"]
+                if event.type.startswith("checkout.") and "payment_id" not in checkout:
+                    # the order was never charged, don't leave it pending with its stock reserved
+                    fail_order(checkout["order_number"])
+                _forget_card_token(event)
+            db.session.commit()
+    return len(events)
+
+
+def run_event_consumer(stop=None):
+    """Process saved webhook events until `stop` (a threading.Event) is set"""
+    event_worker.run(process_due_events, stop)
+
+
+def start_event_consumer():
+    """Start the event consumer thread of this process, once"""
+    event_worker.start(run_event_consumer)
+
+
+if __name__ == "__main__":
+    init_extensions()
+    run_event_consumer()
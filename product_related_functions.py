@@ -0,0 +1,470 @@
+from collections import namedtuple
+import re
+from threading import Event, Lock
+from time import monotonic
+
+from sqlalchemy import text, select, union_all, literal, and_
+from sqlalchemy.orm import joinedload
+
+from db_app import app, db, Products, VariationProducts, ProductColors, UserFav, UserCart, bump_cache_version, \
+    cache_version
+
+# # # # # # # #  CATALOG CACHE  # # # # # # # #
+# Catalog rows and rendered pages, kept as plain snapshots shared between requests. Every process has its own
+# cache and drops it when the "catalog" row of cache_versions moves on (read every CATALOG_VERSION_CHECK_SECONDS).
+_catalog_lock = Lock()
+_catalog = {}  # key -> (loaded_at, value)
+_CATALOG_MAX_ENTRIES = 1024  # listing pages are keyed by cursor, don't let odd cursors grow this forever
+_catalog_version = 0  # the shared version the cached entries were loaded at
+_version_checked_at = None  # monotonic() of the last read of the shared version
+_catalog_generation = 0  # counts the clears of _catalog, a load that started before one is not kept
+_loading = {}  # key -> Event set when the thread loading that key is done
+
+# a rendered storefront page, see anonymous_page_cache in main.py. compressed: encoding -> compressed body, filled
+# by compress_response on the first hit that asks for the encoding
+RenderedPage = namedtuple("RenderedPage", ["body", "headers", "etag", "compressed"])
+
+
+class CatalogItem:
+    """Read-only copy of a Products / VariationProducts row"""
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+
+def _snapshot(product):
+    columns = {column.name: getattr(product, column.name) for column in product.__table__.columns}
+    return CatalogItem(**columns)
+
+
+def _sync_catalog_version():
+    """Drop the cache if the shared catalog version has changed since it was last read"""
+    global _catalog_version, _version_checked_at
+    with _catalog_lock:
+        now = monotonic()
+        if _version_checked_at is not None and now - _version_checked_at < app.config["CATALOG_VERSION_CHECK_SECONDS"]:
+            return
+        _version_checked_at = now  # the other threads keep using the cache while this one reads the row
+    version = cache_version("catalog")
+    with _catalog_lock:
+        if version != _catalog_version:
+            _clear_catalog()
+            _catalog_version = version
+
+
+def _clear_catalog():
+    """Needs _catalog_lock"""
+    global _catalog_generation
+    _catalog.clear()
+    _catalog_generation += 1
+
+
+def _cached(key, loader):
+    """The cached value of `key`, loaded by `loader` when missing or expired. The loader runs outside of the lock,
+    the other threads that need the same key wait for it instead of loading it again."""
+    _sync_catalog_version()
+    while True:
+        with _catalog_lock:
+            entry = _catalog.get(key)
+            if entry is not None and monotonic() - entry[0] <= app.config["CATALOG_CACHE_TTL"]:
+                return entry[1]
+            loading = _loading.get(key)
+            if loading is None:
+                loading = _loading[key] = Event()
+                generation = _catalog_generation
+                break
+        loading.wait()
+
+    try:
+        value = loader()
+        with _catalog_lock:
+            if generation == _catalog_generation:
+                if len(_catalog) >= _CATALOG_MAX_ENTRIES:
+                    _clear_catalog()
+                _catalog[key] = (monotonic(), value)
+    finally:
+        with _catalog_lock:
+            del _loading[key]
+        loading.set()
+    return value
+
+
+def get_parent_products():
+    """Cached list of parent products"""
+    return list(_cached("parents", lambda: [_snapshot(p) for p in Products.query.all()]))
+
+
+def get_variation_products():
+    """Cached list of variation products"""
+    return list(_cached("variations", lambda: [_snapshot(v) for v in VariationProducts.query.all()]))
+
+
+def get_all_products():
+    """Cached list of parent products followed by variation products"""
+    return get_parent_products() + get_variation_products()
+
+
+def invalidate_catalog():
+    """Call in the transaction that changes products, prices or stock, before its commit"""
+    global _version_checked_at
+    bump_cache_version("catalog")
+    with _catalog_lock:
+        _clear_catalog()
+        _version_checked_at = None
+
+
+def catalog_version():
+    """The shared catalog version the cache is at, pass it to store_page"""
+    _sync_catalog_version()
+    return _catalog_version
+
+
+def cached_page(key):
+    """Rendered page kept by store_page, None if there is none or it is older than CATALOG_CACHE_TTL"""
+    _sync_catalog_version()
+    with _catalog_lock:
+        entry = _catalog.get(("page", key))
+        if entry is None or monotonic() - entry[0] > app.config["CATALOG_CACHE_TTL"]:
+            return None
+        return entry[1]
+
+
+def store_page(key, page, version):
+    """Keep a rendered page until the catalog changes. Pages are rendered outside of the lock, so a page is
+    dropped if the catalog changed (catalog_version() is not `version` anymore) while it was rendered."""
+    with _catalog_lock:
+        if version != _catalog_version:
+            return
+        if len(_catalog) >= _CATALOG_MAX_ENTRIES:
+            _clear_catalog()
+        _catalog[("page", key)] = (monotonic(), page)
+
+
+# # # # # # # #  PRODUCT FILTER  # # # # # # # #
+def color_words(color):
+    """Split a product color text into lowercase words. 'Black - 5 Pair' -> ['black', '5', 'pair']"""
+    return sorted({word.lower() for word in color.split() if word.isalnum()})
+
+
+def index_product_colors(product):
+    """(Re)write the product_colors rows of a product"""
+    is_variation = isinstance(product, VariationProducts)
+    remove_product_colors(product.id, is_variation)
+    for word in color_words(product.color):
+        db.session.add(ProductColors(product_id=product.id,
+                                     product_identifier=product.product_identifier,
+                                     is_variation=is_variation,
+                                     color=word))
+
+
+def remove_product_colors(product_id, is_variation):
+    ProductColors.query.filter_by(product_id=product_id, is_variation=is_variation).delete()
+
+
+def _price_facet(model, price_range):
+    minimum_price, maximum_price = price_range
+    return (model.price >= minimum_price) & (model.price < maximum_price)
+
+
+def _color_facet(model, color):
+    matching_ids = db.session.query(ProductColors.product_id).filter(
+        ProductColors.color == color.lower(),
+        ProductColors.is_variation == (model is VariationProducts))
+    return model.id.in_(matching_ids)
+
+
+def _product_type_facet(model, product_type):
+    return model.product_type == product_type
+
+
+def _in_stock_facet(model, in_stock):
+    return model.stock > 0 if in_stock else model.stock <= 0
+
+
+# To add a new filter, add a facet here: name -> function(model, value) returning a sql condition.
+FILTER_FACETS = {
+    "price": _price_facet,
+    "color": _color_facet,
+    "product_type": _product_type_facet,
+    "in_stock": _in_stock_facet,
+}
+
+
+def filtered_query(model, **filters):
+    """Query of `model` (Products or VariationProducts) with every given facet applied in sql.
+    Facets with a None value are skipped."""
+    query = model.query
+    for facet, value in filters.items():
+        if value is not None:
+            query = query.filter(FILTER_FACETS[facet](model, value))
+    return query
+
+
+def filter_products(**filters):
+    """Parent and variation products matching all given facets,
+    e.g. filter_products(price=(0, 100), color="Black", in_stock=True)"""
+    return filtered_query(Products, **filters).all() + filtered_query(VariationProducts, **filters).all()
+
+
+# # # # # # # #  PRODUCT PAGE  # # # # # # # #
+ProductPageData = namedtuple("ProductPageData", ["product", "parent", "variations", "fav"])
+
+
+def load_product_page(model, product_id, product_identifier, user_id=None):
+    """Everything the product page shows, in one query: the product, its parent product, all variations
+    of the parent and the favourite row of `user_id`. Returns None if the product doesn't exist."""
+    if model is Products:
+        loader = joinedload(Products.variations)
+    else:
+        loader = joinedload(VariationProducts.parent_product).joinedload(Products.variations)
+
+    if user_id is None:
+        query = db.session.query(model, db.null())
+    else:
+        fav_match = and_(UserFav.product_id == model.id,
+                         UserFav.product_identifier == model.product_identifier,
+                         UserFav.user_id == user_id)
+        query = db.session.query(model, UserFav).outerjoin(UserFav, fav_match)
+    row = query.options(loader).filter(model.id == product_id, model.product_identifier == product_identifier).first()
+
+    if row is None:
+        return None
+    product, fav = row
+    parent = product if model is Products else product.parent_product
+    variations = parent.variations if parent is not None else []
+    return ProductPageData(product, parent, variations, fav)
+
+
+# # # # # # # #  PAGINATION  # # # # # # # #
+# Listings are paged with a keyset cursor instead of OFFSET: parent products come first, then variations,
+# each ordered by id. The cursor is "<p|v>-<last id shown>", so every page is a "WHERE id > ? LIMIT ?" on the
+# primary key and reads only the rows it shows, no matter how deep the customer scrolls.
+ProductPage = namedtuple("ProductPage", ["products", "next_cursor"])
+
+_CURSOR_MODELS = [("p", Products), ("v", VariationProducts)]
+
+
+def page_size(requested):
+    """Requested page size clamped to 1..MAX_PAGE_SIZE, PAGE_SIZE if missing or not a number"""
+    try:
+        size = int(requested)
+    except (TypeError, ValueError):
+        return app.config["PAGE_SIZE"]
+    return max(1, min(size, app.config["MAX_PAGE_SIZE"]))
+
+
+def _parse_cursor(cursor):
+    try:
+        prefix, last_id = cursor.split("-")
+        if prefix in ("p", "v"):
+            return prefix, int(last_id)
+    except (AttributeError, ValueError):
+        pass
+    return "p", 0  # missing or broken cursor -> first page
+
+
+def product_page(cursor=None, limit=None, include_variations=True, **filters):
+    """One page of products after `cursor`, with the facets of filtered_query applied"""
+    limit = page_size(limit)
+    kind, last_id = _parse_cursor(cursor)
+    models = _CURSOR_MODELS if include_variations else _CURSOR_MODELS[:1]
+
+    rows = []
+    for prefix, model in models:
+        if kind == "v" and prefix == "p":
+            continue  # parents were all shown on earlier pages
+        after_id = last_id if prefix == kind else 0
+        # one extra row tells whether there is a next page
+        batch = filtered_query(model, **filters).filter(model.id > after_id)\
+            .order_by(model.id).limit(limit + 1 - len(rows)).all()
+        rows += [(prefix, row) for row in batch]
+        if len(rows) > limit:
+            break
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1][0]}-{rows[-1][1].id}"
+    return ProductPage([row for _, row in rows], next_cursor)
+
+
+def cached_product_page(cursor=None, limit=None, include_variations=True):
+    """Unfiltered listing page, served from the catalog cache after its first load"""
+    limit = page_size(limit)
+
+    def load_page():
+        page = product_page(cursor, limit, include_variations)
+        return ProductPage([_snapshot(p) for p in page.products], page.next_cursor)
+
+    return _cached(("page", _parse_cursor(cursor), limit, include_variations), load_page)
+
+
+# # # # # # # #  ADMIN INVENTORY  # # # # # # # #
+# Both product tables are read as one UNION ALL listing and sorted by the database.
+# Every sort has an index on (column, id) in both tables, so SQLite merges the two ordered
+# index scans and stops after the requested page instead of sorting the whole catalog.
+INVENTORY_COLUMNS = ["id", "product_identifier", "title", "description1", "description2", "description3",
+                     "price", "stock", "color", "product_type", "main_img_path"]
+
+# filter_by value of the inventory page -> (column, descending)
+INVENTORY_SORTS = {
+    "None": (None, False),
+    "filter_price_asc": ("price", False),
+    "filter_price_desc": ("price", True),
+    "filter_stock_asc": ("stock", False),
+    "filter_stock_desc": ("stock", True),
+    "filter_identifier": ("product_identifier", False),
+    "filter_category": ("product_type", False),
+}
+
+InventoryPage = namedtuple("InventoryPage", ["products", "page", "has_next"])
+
+
+def _inventory_listing():
+    parents = select(*[Products.__table__.c[name] for name in INVENTORY_COLUMNS],
+                     literal(0).label("is_variation"))
+    variations = select(*[VariationProducts.__table__.c[name] for name in INVENTORY_COLUMNS],
+                        literal(1).label("is_variation"))
+    return union_all(parents, variations)
+
+
+def inventory_page(sort_by="None", page=1, per_page=None):
+    """One page of parent and variation products for the admin inventory, sorted by `sort_by`"""
+    per_page = per_page or app.config["MAX_PAGE_SIZE"]
+    try:
+        page = max(1, int(page))
+    except (TypeError, ValueError):
+        page = 1
+    column, descending = INVENTORY_SORTS.get(sort_by, INVENTORY_SORTS["None"])
+
+    listing = _inventory_listing()
+    columns = listing.selected_columns
+    if column is None:
+        # products, then variation_products, as the page always listed them. Without an order a database may
+        # return a different order for every LIMIT/OFFSET and repeat or skip rows between pages.
+        listing = listing.order_by(columns.is_variation, columns.id)
+    elif descending:
+        # id breaks ties in the same direction, so both arms can still be read straight from their indexes
+        listing = listing.order_by(columns[column].desc(), columns.id.desc())
+    else:
+        listing = listing.order_by(columns[column], columns.id)
+
+    rows = db.session.execute(listing.limit(per_page + 1).offset((page - 1) * per_page)).all()
+    return InventoryPage(rows[:per_page], page, len(rows) > per_page)
+
+
+# # # # # # # #  SEARCH INDEX  # # # # # # # #
+# SQLite FTS5 table over the searchable text of both product tables. Rows are ranked with bm25,
+# a match in the title or identifier counts more than one in the descriptions.
+# On PostgreSQL it is a plain table with a weighted tsvector column (migration 5), ranked with ts_rank.
+SEARCH_COLUMNS = ["title", "description1", "description2", "description3", "color", "product_identifier"]
+SEARCH_WEIGHTS = "10.0, 1.0, 1.0, 1.0, 2.0, 5.0"
+
+
+def index_product_search(product):
+    """(Re)write the search row of a product"""
+    is_variation = isinstance(product, VariationProducts)
+    remove_product_search(product.id, is_variation)
+    values = {column: getattr(product, column) or "" for column in SEARCH_COLUMNS}
+    db.session.execute(text(
+        "INSERT INTO product_search (" + ", ".join(SEARCH_COLUMNS) + ", product_id, is_variation) "
+        "VALUES (" + ", ".join(":" + column for column in SEARCH_COLUMNS) + ", :product_id, :is_variation)"
+    ), dict(values, product_id=product.id, is_variation=int(is_variation)))
+
+
+def remove_product_search(product_id, is_variation):
+    db.session.execute(text(
+        "DELETE FROM product_search WHERE product_id = :product_id AND is_variation = :is_variation"
+    ), {"product_id": int(product_id), "is_variation": int(is_variation)})
+
+
+def _match_expression(search_text):
+    # every word has to match, the last one as a prefix so results show up while typing.
+    # words are quoted so user input can't be read as fts5 syntax (AND, NEAR, column filters...).
+    # words without a word character are dropped, "-"* matches no token and would empty every search
+    words = [word.replace('"', '""') for word in search_text.split() if re.search(r"\w", word)]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " AND ".join(terms)
+
+
+def _tsquery_expression(search_text):
+    # same rules for postgres: only word characters are kept, so user input can't be read as tsquery syntax
+    words = re.findall(r"\w+", search_text)
+    if not words:
+        return None
+    return " & ".join(words) + ":*"
+
+
+def search_query(dialect_name, search_text):
+    """(sql, match) of a search for `search_text` on a sqlite or postgresql database, match is None when there is
+    nothing to search for. The sql takes :match, :limit and :offset and returns product_id, is_variation, best
+    match first."""
+    if dialect_name == "postgresql":
+        return ("SELECT product_id, is_variation FROM product_search "
+                "WHERE document @@ to_tsquery('simple', :match) "
+                "ORDER BY ts_rank(document, to_tsquery('simple', :match)) DESC, product_id, is_variation "
+                "LIMIT :limit OFFSET :offset",
+                _tsquery_expression(search_text or ""))
+    return (f"SELECT product_id, is_variation FROM product_search WHERE product_search MATCH :match "
+            f"ORDER BY bm25(product_search, {SEARCH_WEIGHTS}), rowid LIMIT :limit OFFSET :offset",
+            _match_expression(search_text or ""))
+
+
+def search_products(search_text, limit=None, offset=0):
+    """Parent and variation products matching `search_text`, best match first. At most `limit` (MAX_PAGE_SIZE if
+    not given) products, after the first `offset` ones."""
+    sql, match = search_query(db.engine.dialect.name, search_text)
+    if match is None:
+        return []
+    hits = db.session.execute(text(sql), {"match": match, "limit": limit or app.config["MAX_PAGE_SIZE"],
+                                          "offset": offset}).all()
+
+    parent_ids = [int(hit.product_id) for hit in hits if not int(hit.is_variation)]
+    variation_ids = [int(hit.product_id) for hit in hits if int(hit.is_variation)]
+    found = {}
+    if parent_ids:
+        found.update({(0, p.id): p for p in Products.query.filter(Products.id.in_(parent_ids))})
+    if variation_ids:
+        found.update({(1, v.id): v for v in VariationProducts.query.filter(VariationProducts.id.in_(variation_ids))})
+    return [found[key] for key in ((int(hit.is_variation), int(hit.product_id)) for hit in hits) if key in found]
+
+
+def search_inventory_page(search_text, page=1, per_page=None):
+    """One page of the products matching `search_text` for the admin inventory, best match first"""
+    per_page = per_page or app.config["MAX_PAGE_SIZE"]
+    try:
+        page = max(1, int(page))
+    except (TypeError, ValueError):
+        page = 1
+    products = search_products(search_text, limit=per_page + 1, offset=(page - 1) * per_page)
+    return InventoryPage(products[:per_page], page, len(products) > per_page)
+
+
+# # # # # # # #  CARTS AND FAVOURITES  # # # # # # # #
+def update_carts_and_favs(product, price=None, title=None):
+    """Copy a new price and/or title of `product` to every cart and favourite row holding it"""
+    for model in (UserCart, UserFav):
+        values = {}
+        if price is not None:
+            values[model.price] = price
+            values[model.total_price] = model.quantity * price
+        if title is not None:
+            values[model.title] = title
+        if values:
+            model.query.filter_by(product_id=product.id, product_identifier=product.product_identifier)\
+                .update(values, synchronize_session=False)
+
+
+# # # # # # # #  INDEX SYNC  # # # # # # # #
+def index_product(product):
+    """Update the color and search rows of a new or edited product"""
+    index_product_colors(product)
+    index_product_search(product)
+
+
+def unindex_product(product_id, is_variation):
+    """Remove the color and search rows of a deleted product"""
+    remove_product_colors(product_id, is_variation)
+    remove_product_search(product_id, is_variation)
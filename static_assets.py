@@ -0,0 +1,177 @@
+"""Fingerprinted, precompressed copies of the static assets in static/dist/, and local copies of the vendored
+libraries. Does not import the app.
+    python static_assets.py build
+    python static_assets.py vendor
+"""
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import urllib.request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_FOLDER = "static"
+DIST_FOLDER = "static/dist"
+MANIFEST = "manifest.json"
+SKIP_FOLDERS = {"dist", "images"}
+COMPRESS_EXTENSIONS = {".css", ".js", ".svg", ".json", ".txt", ".map"}
+MIN_COMPRESS_SIZE = 256
+
+# name: (cdn url, file in static/, subresource integrity of the cdn file or None)
+VENDOR = {
+    "bootstrap.css": ("https://cdn.jsdelivr.net/npm/bootstrap@5.0.2/dist/css/bootstrap.min.css",
+                      "vendor/bootstrap/bootstrap.min.css",
+                      "sha384-EVSTQN3/azprG1Anm3QDgpJLIm9Nao0Yz1ztcQTwFspd3yD65VohhpuuCOmLASjC"),
+    "bootstrap.js": ("https://cdn.jsdelivr.net/npm/bootstrap@5.0.2/dist/js/bootstrap.bundle.min.js",
+                     "vendor/bootstrap/bootstrap.bundle.min.js",
+                     "sha384-MrcW6ZMFYlzcLA8Nl+NtUVF0sA7MsXsP1UyJoMp4YLEuNSfAP+JcXn/tWtIaxVXM"),
+    # the version the templates always used, the "fa-solid" names come from the kit script in header.html
+    "fontawesome.js": ("https://use.fontawesome.com/releases/v5.15.4/js/all.js",
+                       "vendor/fontawesome/all.js",
+                       "sha384-rOA1PnstxnOBLzCLMcre8ybwbTmemjzdNlILg8O7z1lUkLXozs4DHonlDtnE7fpc"),
+    "poppins.css": ("https://fonts.googleapis.com/css2?family=Poppins:wght@100;200;400;500;800;900&display=swap",
+                    "vendor/fonts/poppins.css",
+                    None),
+}
+# google fonts sends woff2 only to browsers it knows
+FONT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) " \
+                  "Chrome/120.0 Safari/537.36"
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+# # # # # # # #  BUILD  # # # # # # # #
+def _hashed_name(name, content):
+    root, ext = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:10]}{ext}"
+
+
+def _write(path, content):
+    if os.path.exists(path):
+        return  # hashed names, an existing file already has this content
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(content)
+    os.replace(temp_path, path)
+
+
+def _rewrite_css_urls(name, content, manifest):
+    folder = os.path.dirname(name)
+
+    def replace(match):
+        url = match.group(2)
+        if re.match(r"^(data:|https?:|//|#)", url):
+            return match.group(0)
+        path, _, query = url.partition("?")
+        target = os.path.normpath(os.path.join(folder, path)).replace(os.sep, "/")
+        if target not in manifest:
+            return match.group(0)
+        return f"url({os.path.relpath(manifest[target], folder or '.').replace(os.sep, '/')})"
+
+    return CSS_URL.sub(replace, content.decode("utf-8")).encode("utf-8")
+
+
+def _assets(static_folder):
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder:
+            dirs[:] = [d for d in dirs if d not in SKIP_FOLDERS and not d.startswith(".")]
+        for file in sorted(files):
+            if not file.startswith("."):
+                yield os.path.relpath(os.path.join(root, file), static_folder).replace(os.sep, "/")
+
+
+def build(static_folder=STATIC_FOLDER, dist_folder=DIST_FOLDER):
+    """Write the hashed and compressed copies of every asset and the manifest. Returns the manifest."""
+    names = list(_assets(static_folder))
+    # css last, so the files they reference already have their hashed names
+    names.sort(key=lambda name: name.endswith(".css"))
+    manifest = {}
+    for name in names:
+        with open(os.path.join(static_folder, name), "rb") as file:
+            content = file.read()
+        if name.endswith(".css"):
+            content = _rewrite_css_urls(name, content, manifest)
+        hashed = _hashed_name(name, content)
+        manifest[name] = hashed
+        path = os.path.join(dist_folder, hashed)
+        _write(path, content)
+        if os.path.splitext(name)[1] in COMPRESS_EXTENSIONS and len(content) >= MIN_COMPRESS_SIZE:
+            _write(path + ".gz", gzip.compress(content, compresslevel=9, mtime=0))
+            if brotli is not None:
+                _write(path + ".br", brotli.compress(content, quality=11))
+
+    manifest_content = json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8")
+    manifest_path = os.path.join(dist_folder, MANIFEST)
+    os.makedirs(dist_folder, exist_ok=True)
+    with open(manifest_path + ".tmp", "wb") as file:
+        file.write(manifest_content)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+# # # # # # # #  VENDOR  # # # # # # # #
+def _download(url, user_agent=None):
+    request = urllib.request.Request(url, headers={"User-Agent": user_agent or "python-urllib"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.read()
+
+
+def subresource_integrity(content, algorithm="sha384"):
+    """The integrity="" value of a file"""
+    return f"{algorithm}-{base64.b64encode(hashlib.new(algorithm, content).digest()).decode()}"
+
+
+def _check_integrity(name, content, integrity):
+    if subresource_integrity(content, integrity.partition("-")[0]) != integrity:
+        raise ValueError(f"{name}: integrity check failed, the cdn file has changed")
+
+
+def vendor(static_folder=STATIC_FOLDER):
+    """Download the VENDOR files into static/vendor/"""
+    for name, (url, local, integrity) in VENDOR.items():
+        path = os.path.join(static_folder, local)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if name.endswith(".css") and "fonts.googleapis.com" in url:
+            css = _download(url, FONT_USER_AGENT).decode("utf-8")
+            # the font files go next to the css, which then links them relatively
+            for font_url in sorted(set(m.group(2) for m in CSS_URL.finditer(css))):
+                font_name = os.path.basename(font_url.split("?")[0])
+                with open(os.path.join(os.path.dirname(path), font_name), "wb") as file:
+                    file.write(_download(font_url))
+                css = css.replace(font_url, font_name)
+            content = css.encode("utf-8")
+        else:
+            content = _download(url)
+            if integrity:
+                _check_integrity(name, content, integrity)
+            else:
+                print(f"{name}: no integrity pinned in VENDOR, check the file and pin {subresource_integrity(content)}")
+        with open(path, "wb") as file:
+            file.write(content)
+        print(f"{name}: {local} ({len(content) // 1024} KB)")
+
+
+def clean(dist_folder=DIST_FOLDER):
+    shutil.rmtree(dist_folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the fingerprinted static assets")
+    parser.add_argument("command", choices=["build", "vendor", "clean"])
+    args = parser.parse_args()
+    if args.command == "vendor":
+        vendor()
+        build()
+    elif args.command == "build":
+        print(f"{len(build())} assets in {DIST_FOLDER}")
+    else:
+        clean()
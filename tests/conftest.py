@@ -0,0 +1,146 @@
+"""Every test runs against a throwaway sqlite database with the background workers off, the tables are emptied
+after each test. Run from the repository root with:
+    python -m pytest -q
+Set TEST_POSTGRES_URL to run the whole suite on that PostgreSQL database instead (its tables are emptied too).
+"""
+import os
+import sys
+import tempfile
+
+_database_folder = tempfile.mkdtemp(prefix="shop-tests-")
+os.environ.update(
+    DATABASE_URL=os.getenv("TEST_POSTGRES_URL") or f"sqlite:///{_database_folder}/test.db",
+    SECRET_KEY="test",
+    STRIPE_SECRET_KEY="sk_test",
+    EMAIL_WORKER="off",
+    STRIPE_EVENT_WORKER="off",
+    PASSWORD_WORKERS="0",
+    ORDER_SLOTS_FOLDER=os.path.join(_database_folder, "order-slots"),
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from flask import g  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+import user_related_functions  # noqa: E402
+from product_related_functions import invalidate_catalog  # noqa: E402
+
+from db_app import app as flask_app, db, init_extensions, create_schema, User, AdminUser, UserAddresses, \
+    UserBillingAddresses, Products, VariationProducts, Orders  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    import main  # noqa: F401, registers the routes
+    init_extensions()
+    with flask_app.app_context():
+        create_schema()
+    return flask_app
+
+
+@pytest.fixture(autouse=True)
+def app_context(app):
+    with app.app_context():
+        yield
+        db.session.rollback()
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.execute(text("DELETE FROM product_search"))
+        # ids are reused by the next test, so are the cached rows of this one
+        invalidate_catalog()
+        db.session.commit()
+        user_related_functions._principals.clear()
+
+
+def _address(model, user):
+    return model(address_title="Home", address_line="1 Test Street", city="Testville", state="TS",
+                 postal_code="12345", country="Testland", name=user.name, surname=user.surname,
+                 phone_number_ext="+1", phone_number="5550000", user_id=user.id)
+
+
+@pytest.fixture
+def make_user():
+    def make(email="user@example.com"):
+        user = User(name="Test", surname="User", birthdate="2000-01-01", gender="other", phone_number_ext="+1",
+                    phone_number="5550000", email=email, password="x")
+        db.session.add(user)
+        db.session.flush()
+        db.session.add_all([_address(UserAddresses, user), _address(UserBillingAddresses, user)])
+        db.session.commit()
+        return user
+    return make
+
+
+@pytest.fixture
+def make_product():
+    def make(stock=10, price=15.0, identifier="TEST-1"):
+        product = Products(product_identifier=identifier, variation_type="parent", title=f"Product {identifier}",
+                           price=price, stock=stock, color="Green", product_type="metal",
+                           file_path=f"static/images/metal/{identifier}")
+        db.session.add(product)
+        db.session.commit()
+        return product
+    return make
+
+
+@pytest.fixture
+def make_variation():
+    def make(parent, identifier, price=15.0, stock=10, color="Blue"):
+        variation = VariationProducts(product_identifier=identifier, variation_type="variation",
+                                      parent_product_id=str(parent.id),
+                                      parent_product_identifier=parent.product_identifier,
+                                      title=f"Variation {identifier}", price=price, stock=stock, color=color,
+                                      product_type=parent.product_type, file_path=parent.file_path)
+        db.session.add(variation)
+        db.session.commit()
+        return variation
+    return make
+
+
+@pytest.fixture
+def make_order():
+    """A "Payment Pending" order of `quantity` units of `product`, with its stock already reserved"""
+    from order_related_functions import add_order_details, STATUS_PAYMENT_PENDING
+
+    def make(user, product, quantity=1, order_number=1001):
+        product.stock -= quantity
+        order = Orders(order_number=order_number, product_identifiers=product.product_identifier,
+                       customer_name=user.name, customer_surname=user.surname,
+                       delivery_address_ids=user.user_address[0].id,
+                       billing_address_ids=user.user_billing_address[0].id, delivery_cost=0,
+                       total_order_value=product.price * quantity, order_date="01/01/2026 12:00:00",
+                       payment_status=STATUS_PAYMENT_PENDING, shipment_status=STATUS_PAYMENT_PENDING,
+                       user_id=user.id)
+        db.session.add(order)
+        line = type("CartLine", (), dict(product_id=product.id, product_identifier=product.product_identifier,
+                                         title=product.title, color=product.color, price=product.price,
+                                         quantity=quantity, total_price=product.price * quantity,
+                                         main_img_path="x"))
+        add_order_details([line], order, user.id)
+        return order
+    return make
+
+
+@pytest.fixture
+def client(app):
+    """Test client, client.login(account) logs a User or AdminUser in"""
+    client = app.test_client()
+
+    def login(account):
+        with client.session_transaction() as session:
+            session["_user_id"] = str(account.id)
+        # requests share the app context of the test, so its g still holds the user of the last request
+        g.pop("_login_user", None)
+    client.login = login
+    return client
+
+
+@pytest.fixture
+def make_admin():
+    def make(email="admin@example.com"):
+        admin = AdminUser(id=1001, name="Test", surname="Admin", email=email, password="x")
+        db.session.add(admin)
+        db.session.commit()
+        return admin
+    return make
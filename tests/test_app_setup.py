@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_create_app_leaves_assets_and_workers_to_the_first_request(app, monkeypatch):
+    started = []
+    monkeypatch.setattr(main, "load_manifest", lambda: started.append("assets"))
+    monkeypatch.setattr(main, "start_email_sender", lambda: started.append("email-sender"))
+    monkeypatch.setattr(main, "start_event_consumer", lambda: started.append("stripe-events"))
+    monkeypatch.setattr(main, "_serving", False)
+    monkeypatch.setitem(app.config, "EMAIL_WORKER", "thread")
+    monkeypatch.setitem(app.config, "STRIPE_EVENT_WORKER", "thread")
+    # the hook create_app adds must not outlive this test
+    monkeypatch.setattr(app, "before_request_funcs",
+                        {key: list(funcs) for key, funcs in app.before_request_funcs.items()})
+
+    main.create_app()
+    main.create_app()
+    assert started == []  # what `flask --app wsgi create-schema` gets
+
+    client = app.test_client()
+    client.get("/")
+    client.get("/")
+    assert started == ["assets", "email-sender", "stripe-events"]
+
+
+def test_importing_the_app_changes_nothing_outside_of_it(tmp_path):
+    (tmp_path / ".env").write_text("SHOP_TEST_FROM_DOTENV=1\n")
+    env = dict(os.environ, STRIPE_SECRET_KEY="sk_test_import", PYTHONPATH=ROOT)
+    output = subprocess.run(
+        [sys.executable, "-c", "import os, stripe, main; print(stripe.api_key, os.getenv('SHOP_TEST_FROM_DOTENV'))"],
+        cwd=tmp_path, env=env, capture_output=True, text=True, check=True).stdout
+    assert output.split() == ["None", "None"]
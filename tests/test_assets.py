@@ -0,0 +1,32 @@
+import asset_related_functions
+from static_assets import subresource_integrity, VENDOR
+
+FONTAWESOME = VENDOR["fontawesome.js"][1]
+
+
+def test_icons_load_from_the_pinned_cdn_file_until_vendored(client, monkeypatch):
+    monkeypatch.setattr(asset_related_functions, "_manifest", {})
+    page = client.get("/").data.decode()
+    cdn_url, _, integrity = VENDOR["fontawesome.js"]
+    assert f'src="{cdn_url}" integrity="{integrity}" crossorigin="anonymous"' in page
+    assert 'src="https://kit.fontawesome.com/' in page
+    assert f'integrity="{VENDOR["bootstrap.js"][2]}"' in page
+
+
+def test_a_script_without_pinned_integrity_is_not_taken_from_its_cdn(monkeypatch):
+    monkeypatch.setattr(asset_related_functions, "_manifest", {})
+    monkeypatch.setitem(VENDOR, "fontawesome.js", VENDOR["fontawesome.js"][:2] + (None,))
+    assert asset_related_functions.vendor_url("fontawesome.js") is None
+
+
+def test_the_local_copy_is_linked_with_its_integrity(client, monkeypatch, tmp_path):
+    hashed = "vendor/fontawesome/all.0123456789.js"
+    (tmp_path / "vendor" / "fontawesome").mkdir(parents=True)
+    (tmp_path / hashed).write_bytes(b"window.FontAwesome = {};")
+    monkeypatch.setattr(asset_related_functions, "DIST_FOLDER", str(tmp_path))
+    monkeypatch.setattr(asset_related_functions, "_manifest", {FONTAWESOME: hashed})
+    monkeypatch.setattr(asset_related_functions, "_local_integrity", {})
+
+    page = client.get("/").data.decode()
+    integrity = subresource_integrity(b"window.FontAwesome = {};")
+    assert f'src="/assets/{hashed}" integrity="{integrity}" crossorigin="anonymous"' in page
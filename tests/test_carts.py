@@ -0,0 +1,44 @@
+from db_app import db, UserCart, UserFav
+from product_related_functions import update_carts_and_favs
+
+
+def _line(model, user, product, quantity):
+    line = model(product_id=product.id, product_identifier=product.product_identifier, title=product.title,
+                 color=product.color, price=product.price, quantity=quantity, total_price=product.price * quantity,
+                 main_img_path="x", user_id=user.id)
+    db.session.add(line)
+    db.session.commit()
+    return line.id
+
+
+def _rows(model, ids):
+    db.session.expire_all()
+    return [(row.title, row.price, row.total_price) for row in (model.query.get(row_id) for row_id in ids)]
+
+
+def test_a_price_and_title_change_reaches_only_the_rows_holding_the_product(make_user, make_product,
+                                                                           make_variation):
+    user, other_user = make_user(), make_user("other@example.com")
+    gate, hook = make_product(identifier="GATE", price=10.0), make_product(identifier="HOOK", price=5.0)
+    same_id = make_variation(hook, "GATE-V", price=7.0)  # variation 1 has the same id as product 1
+    carts = [_line(UserCart, user, gate, 3), _line(UserCart, other_user, gate, 1),
+             _line(UserCart, user, hook, 2), _line(UserCart, user, same_id, 2)]
+    favs = [_line(UserFav, other_user, gate, 1), _line(UserFav, user, hook, 1)]
+
+    update_carts_and_favs(gate, price=12.5, title="Garden gate")
+    db.session.commit()
+
+    assert _rows(UserCart, carts) == [("Garden gate", 12.5, 37.5), ("Garden gate", 12.5, 12.5),
+                                      ("Product HOOK", 5.0, 10.0), ("Variation GATE-V", 7.0, 14.0)]
+    assert _rows(UserFav, favs) == [("Garden gate", 12.5, 12.5), ("Product HOOK", 5.0, 5.0)]
+
+
+def test_an_admin_price_edit_updates_the_carts(client, make_admin, make_user, make_product):
+    user, gate = make_user(), make_product(identifier="GATE", price=10.0)
+    cart = _line(UserCart, user, gate, 2)
+    client.login(make_admin())
+
+    client.post("/admin/inventory/update", data={"product_id": gate.id, "product_identifier": "GATE",
+                                                 "action": "update_price_stock", "price": "11", "stock": ""})
+
+    assert _rows(UserCart, [cart]) == [("Product GATE", 11.0, 22.0)]
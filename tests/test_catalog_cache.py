@@ -0,0 +1,79 @@
+import threading
+
+from sqlalchemy import text
+
+import product_related_functions
+from db_app import db
+from product_related_functions import get_parent_products
+
+
+def _change_in_another_process(sql):
+    """What a product change in another worker looks like to this one: committed rows and a bumped version"""
+    with db.engine.begin() as connection:
+        connection.execute(text(sql))
+        connection.execute(text("UPDATE cache_versions SET version = version + 1 WHERE name = 'catalog'"))
+    db.session.expire_all()  # the tests and their requests share one session, a real request starts a new one
+
+
+def _titles():
+    return [product.title for product in get_parent_products()]
+
+
+def test_a_change_in_another_process_is_seen_after_the_version_check(app, make_product, monkeypatch):
+    make_product(identifier="GATE-1")
+    monkeypatch.setitem(app.config, "CATALOG_VERSION_CHECK_SECONDS", 3600)
+    assert _titles() == ["Product GATE-1"]
+
+    _change_in_another_process("UPDATE products SET title = 'Garden gate'")
+    assert _titles() == ["Product GATE-1"]  # the version is not read again yet
+
+    monkeypatch.setitem(app.config, "CATALOG_VERSION_CHECK_SECONDS", 0)
+    assert _titles() == ["Garden gate"]
+
+
+def test_a_change_without_a_new_version_is_served_from_the_cache(app, make_product, monkeypatch):
+    make_product(identifier="GATE-1")
+    monkeypatch.setitem(app.config, "CATALOG_VERSION_CHECK_SECONDS", 0)
+    assert _titles() == ["Product GATE-1"]
+    with db.engine.begin() as connection:
+        connection.execute(text("UPDATE products SET title = 'Garden gate'"))
+    assert _titles() == ["Product GATE-1"]
+
+
+def test_cached_pages_are_dropped_when_another_process_changes_the_catalog(app, client, make_product, monkeypatch):
+    product = make_product(identifier="GATE-1")
+    product.main_img_path = "static/images/metal/GATE-1/main.jpg"
+    db.session.commit()
+    monkeypatch.setitem(app.config, "CATALOG_VERSION_CHECK_SECONDS", 0)
+    assert b"Product GATE-1" in client.get("/").data
+
+    _change_in_another_process("UPDATE products SET title = 'Garden gate'")
+    page = client.get("/").data
+    assert b"Garden gate" in page and b"Product GATE-1" not in page
+
+
+def test_a_key_is_loaded_once_and_without_holding_the_lock(app, monkeypatch):
+    monkeypatch.setitem(app.config, "CATALOG_VERSION_CHECK_SECONDS", 3600)
+    product_related_functions.catalog_version()
+    release, loads, results = threading.Event(), [], []
+
+    def slow_loader():
+        loads.append("slow")
+        # other keys are served while this one loads
+        assert product_related_functions._cached("other", lambda: "other") == "other"
+        release.wait(5)
+        return "slow"
+
+    def read():
+        with app.app_context():
+            results.append(product_related_functions._cached("slow", slow_loader))
+
+    threads = [threading.Thread(target=read) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["slow"] * 3
+    assert loads == ["slow"]
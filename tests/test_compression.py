@@ -0,0 +1,31 @@
+import gzip
+
+import asset_related_functions
+
+
+def test_a_cached_page_is_compressed_once_per_encoding(client, monkeypatch):
+    monkeypatch.setattr(asset_related_functions, "brotli", None)
+    calls = []
+    compress = asset_related_functions._compress
+    monkeypatch.setattr(asset_related_functions, "_compress",
+                        lambda body, encoding: calls.append(encoding) or compress(body, encoding))
+
+    plain = client.get("/").data
+    first = client.get("/", headers={"Accept-Encoding": "gzip"})
+    second = client.get("/", headers={"Accept-Encoding": "gzip"})
+
+    assert calls == ["gzip"]
+    assert first.headers["Content-Encoding"] == second.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(first.data) == gzip.decompress(second.data) == plain
+    assert "Accept-Encoding" in second.headers["Vary"]
+
+    etag = second.headers["ETag"]
+    assert etag.startswith("W/")
+    assert client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}).status_code == 304
+
+
+def test_pages_of_logged_in_users_are_still_compressed(client, make_user):
+    client.login(make_user())
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert b"<html" in gzip.decompress(response.data)
@@ -0,0 +1,77 @@
+from db_app import db, EmailOutbox, OrderDetails, OrderNotifications
+from email_related_functions import queue_email, send_due_emails, notify_order_status, queue_order_digests, \
+    MAX_ATTEMPTS, DIGEST_QUIET_SECONDS
+
+
+class FakeConnection:
+    """Collects the sent messages, raises `error` for emails to `failing_address`"""
+
+    def __init__(self, failing_address=None, error=None):
+        self.failing_address = failing_address
+        self.error = error
+        self.sent = []
+        self.closed = 0
+
+    def send(self, message):
+        if message["To"] == self.failing_address:
+            raise self.error
+        self.sent.append(message["To"])
+
+    def close(self):
+        self.closed += 1
+
+
+def _statuses():
+    return {email.to_address: (email.status, email.attempts) for email in EmailOutbox.query.all()}
+
+
+def test_an_unexpected_error_is_retried_and_the_rest_of_the_batch_is_sent():
+    for address in ["a@example.com", "bad@example.com", "c@example.com"]:
+        queue_email(address, "Hello", "Body")
+    connection = FakeConnection("bad@example.com", ValueError("Header values may not contain linefeed"))
+
+    assert send_due_emails(connection) == 3
+
+    assert connection.sent == ["a@example.com", "c@example.com"]
+    assert connection.closed == 1
+    assert _statuses() == {"a@example.com": ("sent", 0), "bad@example.com": ("pending", 1),
+                           "c@example.com": ("sent", 0)}
+    assert EmailOutbox.query.filter_by(to_address="bad@example.com").one().last_error.startswith("ValueError")
+
+
+def test_an_email_is_given_up_after_max_attempts():
+    queue_email("bad@example.com", "Hello", "Body")
+    email = EmailOutbox.query.one()
+    email.attempts = MAX_ATTEMPTS - 1
+    db.session.commit()
+
+    send_due_emails(FakeConnection("bad@example.com", OSError("connection refused")))
+
+    assert _statuses() == {"bad@example.com": ("failed", MAX_ATTEMPTS)}
+
+
+def test_status_changes_of_a_customer_are_sent_as_one_digest_once(make_user, make_product, make_order):
+    user = make_user()
+    make_order(user, make_product(identifier="GATE-1"), order_number=1)
+    make_order(user, make_product(identifier="GATE-2"), order_number=2)
+    for detail in OrderDetails.query.all():
+        notify_order_status(detail, "Shipped")
+    notify_order_status(OrderDetails.query.first(), "Delivered")
+    db.session.commit()
+    assert queue_order_digests() == 0  # the customer may get more changes soon
+
+    OrderNotifications.query.update({OrderNotifications.created_at: OrderNotifications.created_at
+                                     - DIGEST_QUIET_SECONDS - 1})
+    db.session.commit()
+    assert queue_order_digests() == 1
+    assert queue_order_digests() == 0
+
+    digest = EmailOutbox.query.one()
+    assert digest.to_address == user.email
+    for line in ["Order 1", "Order 2", "Product GATE-1: Shipped", "Product GATE-1: Delivered",
+                 "Product GATE-2: Shipped"]:
+        assert line in digest.body
+    connection = FakeConnection()
+    send_due_emails(connection)
+    send_due_emails(connection)
+    assert connection.sent == [user.email]
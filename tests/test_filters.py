@@ -0,0 +1,48 @@
+import pytest
+
+from db_app import db, Products
+from product_related_functions import filter_products, index_product
+
+
+@pytest.fixture
+def catalog(make_product, make_variation):
+    socks = make_product(identifier="SOCKS", price=10.0, stock=5)
+    socks.color = "Black - 5 Pair"
+    gate = make_product(identifier="GATE", price=50.0, stock=0)
+    gate.product_type = "wood"
+    products = [socks, gate, make_variation(socks, "SOCKS-V", price=20.0, stock=3, color="Black")]
+    for product in products:
+        index_product(product)
+    db.session.commit()
+
+
+def _found(**filters):
+    return sorted(product.product_identifier for product in filter_products(**filters))
+
+
+@pytest.mark.usefixtures("catalog")
+def test_every_facet_is_applied_to_parents_and_variations():
+    assert _found(color="black") == ["SOCKS", "SOCKS-V"]
+    assert _found(color="Pair") == ["SOCKS"]
+    assert _found(price=(0, 30)) == ["SOCKS", "SOCKS-V"]
+    assert _found(price=(20, 50)) == ["SOCKS-V"]  # the upper bound is not included
+    assert _found(product_type="wood") == ["GATE"]
+    assert _found(in_stock=True) == ["SOCKS", "SOCKS-V"]
+    assert _found(in_stock=False) == ["GATE"]
+
+
+@pytest.mark.usefixtures("catalog")
+def test_facets_are_combined_and_none_is_skipped():
+    assert _found(color="black", price=(15, 100)) == ["SOCKS-V"]
+    assert _found(color="black", product_type="wood") == []
+    assert _found(color=None, in_stock=None) == ["GATE", "SOCKS", "SOCKS-V"]
+
+
+@pytest.mark.usefixtures("catalog")
+def test_a_color_change_is_seen_after_reindexing():
+    gate = Products.query.filter_by(product_identifier="GATE").one()
+    gate.color = "Black"
+    index_product(gate)
+    db.session.commit()
+
+    assert _found(color="black") == ["GATE", "SOCKS", "SOCKS-V"]
@@ -0,0 +1,38 @@
+from db_app import db
+from image_derivatives import SIZES, FORMATS, has_derivatives
+from image_related_functions import image_url, image_srcset
+
+MAIN = "static/images/metal/GATE-1/main.jpg"
+SECOND = "static/images/metal/GATE-1/second.jpg"
+
+
+def test_a_missing_image_has_no_urls():
+    assert image_url(None) == "" and image_srcset(None) == "" and has_derivatives(None) is False
+
+
+def test_products_without_images_are_listed(client, make_product):
+    make_product(identifier="GATE-1")  # main_img_path is None
+    assert client.get("/").status_code == 200
+    assert client.get("/products").status_code == 200
+
+
+def test_product_page_uses_the_thumb_card_and_zoom_copies(client, make_product, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # derivatives are looked up relative to the working directory
+    for original in (MAIN, SECOND):
+        name = original[len("static/images/"):-len(".jpg")]
+        for size in SIZES:
+            for fmt in FORMATS:
+                path = tmp_path / "static/images/derived" / f"{name}-{size}.{fmt}"
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(b"")
+    product = make_product(identifier="GATE-1")
+    product.main_img_path, product.second_img_path = MAIN, SECOND
+    db.session.commit()
+
+    page = client.get(f"/product/parent/{product.id}/GATE-1/").data.decode()
+
+    assert 'src="/static/images/derived/metal/GATE-1/main-card.jpg" onclick' in page
+    for name in ("main", "second"):
+        assert f'src="/static/images/derived/metal/GATE-1/{name}-thumb.jpg"' in page
+        assert f'src="/static/images/derived/metal/GATE-1/{name}-zoom.jpg"' in page
+    assert "None" not in page.split("<ul id=\"thumbnails\">")[1].split("</ul>")[0]
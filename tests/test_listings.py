@@ -0,0 +1,56 @@
+import pytest
+
+from product_related_functions import product_page
+
+
+@pytest.fixture
+def catalog(make_product, make_variation):
+    parents = [make_product(identifier=f"P-{number}", stock=number % 2) for number in range(5)]
+    make_variation(parents[0], "V-0")
+    make_variation(parents[1], "V-1", stock=0)
+
+
+def _walk(limit, **kwargs):
+    """Identifiers of every page, following the next cursors, and the number of pages"""
+    identifiers, cursor, pages = [], None, 0
+    while True:
+        page = product_page(cursor, limit, **kwargs)
+        assert len(page.products) <= limit
+        identifiers += [product.product_identifier for product in page.products]
+        pages += 1
+        if page.next_cursor is None:
+            return identifiers, pages
+        cursor = page.next_cursor
+
+
+@pytest.mark.usefixtures("catalog")
+def test_pages_list_every_product_once_parents_first():
+    assert _walk(3) == (["P-0", "P-1", "P-2", "P-3", "P-4", "V-0", "V-1"], 3)
+    assert _walk(3, include_variations=False) == (["P-0", "P-1", "P-2", "P-3", "P-4"], 2)
+    assert _walk(2, in_stock=True) == (["P-1", "P-3", "V-0"], 2)
+
+
+@pytest.mark.usefixtures("catalog")
+def test_a_page_is_not_changed_by_products_added_before_its_cursor(make_product):
+    first = product_page(None, 2)
+    make_product(identifier="P-5")
+
+    assert [product.product_identifier for product in product_page(first.next_cursor, 2).products] == ["P-2", "P-3"]
+
+
+@pytest.mark.usefixtures("catalog")
+def test_broken_cursors_and_limits_fall_back_to_the_first_page(app):
+    assert [product.product_identifier for product in product_page("x-y", "many").products][:1] == ["P-0"]
+    assert len(product_page(None, 10 ** 6).products) == min(7, app.config["MAX_PAGE_SIZE"])
+
+
+@pytest.mark.usefixtures("catalog")
+def test_load_more_returns_the_cards_and_the_next_page_url(client):
+    response = client.get("/products?limit=3&partial=1")
+
+    assert response.status_code == 200
+    assert b"Product P-2" in response.data and b"Product P-3" not in response.data
+    assert response.headers["X-Next-Url"].startswith("/products?after=p-")
+    last = client.get(response.headers["X-Next-Url"].replace("limit=3", "limit=10") + "&partial=1")
+    assert b"Product P-3" in last.data and b"Product P-0" not in last.data
+    assert last.headers["X-Next-Url"] == ""
@@ -0,0 +1,17 @@
+import pytest
+from sqlalchemy import text
+
+from db_app import db
+from migrations import MIGRATIONS, applied_versions
+
+
+def test_every_migration_is_recorded():
+    assert applied_versions(db.engine) == {version for version, *_ in MIGRATIONS}
+
+
+def test_postgres_migrations_do_not_run_on_sqlite():
+    if db.engine.dialect.name != "sqlite":
+        pytest.skip("the suite runs on PostgreSQL")
+    # product_search is still migration 1's fts5 table, migration 5 would have made a plain table
+    sql = db.session.execute(text("SELECT sql FROM sqlite_master WHERE name = 'product_search'")).scalar()
+    assert "fts5" in sql
@@ -0,0 +1,62 @@
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import functions
+from functions import order_num, ORDER_SEQUENCE_BITS, ORDER_PROCESS_BITS
+
+
+def _slot(number):
+    return (number >> ORDER_SEQUENCE_BITS) % 2 ** ORDER_PROCESS_BITS
+
+
+def _order_numbers_in_child(started, release, results):
+    numbers = [order_num() for _ in range(100)]
+    started.put(os.getpid())
+    release.wait()  # the slot stays taken while the process lives
+    results.put(numbers)
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_processes_of_a_host_never_share_a_slot():
+    parent_numbers = [order_num()]
+    context = multiprocessing.get_context("fork")  # the children inherit this process' order state
+    started, results, release = context.Queue(), context.Queue(), context.Event()
+    children = [context.Process(target=_order_numbers_in_child, args=(started, release, results)) for _ in range(4)]
+    for child in children:
+        child.start()
+    for _ in children:
+        started.get(timeout=10)
+    release.set()
+    child_numbers = [results.get(timeout=10) for _ in children]
+    for child in children:
+        child.join()
+
+    slots = {_slot(parent_numbers[0])} | {_slot(numbers[0]) for numbers in child_numbers}
+    assert len(slots) == len(children) + 1
+    every_number = parent_numbers + [number for numbers in child_numbers for number in numbers]
+    assert len(set(every_number)) == len(every_number)
+
+
+def test_numbers_are_unique_and_increasing_across_threads():
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        per_thread = list(pool.map(lambda _: [order_num() for _ in range(500)], range(8)))
+    for numbers in per_thread:
+        assert numbers == sorted(numbers)
+    every_number = [number for numbers in per_thread for number in numbers]
+    assert len(set(every_number)) == len(every_number)
+
+
+def test_numbers_keep_increasing_when_the_clock_goes_back(monkeypatch):
+    before = order_num()
+    monkeypatch.setattr(functions, "time", lambda: 1704067200.0 + 60)  # long before `before` was made
+    after = [order_num() for _ in range(5000)]  # more than one ms worth of sequence numbers
+    assert before < after[0] and after == sorted(after) and len(set(after)) == len(after)
+
+
+@pytest.mark.parametrize("host_id", [-1, 2 ** functions.ORDER_HOST_BITS])
+def test_a_host_id_out_of_range_is_refused(host_id):
+    with pytest.raises(ValueError):
+        functions._check_host_id(host_id)
@@ -0,0 +1,81 @@
+import re
+
+from db_app import db, Orders, OrderDetails
+from order_related_functions import finalize_order
+
+
+def _row_cells(html):
+    body = html.split("<tbody", 1)[1]
+    return [len(re.findall(r"<t[dh][ >]", row)) for row in body.split("<tr")[1:]]
+
+
+def _orders_in_every_state(user, product, make_order):
+    for number, (payment_status, shipment_status) in enumerate([
+        ("Payment Pending", "Payment Pending"),
+        ("Payment Failed", "Payment Failed"),
+        ("succeeded", "Being Prepared"),
+        ("succeeded", "Delivered"),
+    ], start=1):
+        order = make_order(user, product, order_number=number)
+        order.payment_status, order.shipment_status = payment_status, shipment_status
+    db.session.commit()
+
+
+def test_admin_orders_rows_have_a_cell_for_every_status(client, make_admin, make_user, make_product, make_order):
+    _orders_in_every_state(make_user(), make_product(), make_order)
+    client.login(make_admin())
+
+    response = client.get("/admin/orders_all/filter/None/")
+
+    assert response.status_code == 200
+    cells = _row_cells(response.get_data(as_text=True))
+    assert len(cells) == Orders.query.count()
+    assert len(set(cells)) == 1
+
+
+def test_profile_orders_rows_have_a_cell_for_every_status(client, make_user, make_product, make_order):
+    user = make_user()
+    _orders_in_every_state(user, make_product(), make_order)
+    client.login(user)
+
+    response = client.get("/profile")
+
+    assert response.status_code == 200
+    cells = _row_cells(response.get_data(as_text=True))
+    assert len(cells) == Orders.query.count()
+    assert len(set(cells)) == 1
+
+
+def _ship(client, order, detail):
+    return client.post(f"/admin/order/create_shipment/{order.order_number}/{detail.id}/{order.user_id}/",
+                       data={"tracking_no": "TRK1", "company": "Post", "date": "2026-01-10", "status": "Shipped"},
+                       headers={"Referer": "/"})
+
+
+def test_unpaid_lines_can_not_be_shipped(client, make_admin, make_user, make_product, make_order):
+    order = make_order(make_user(), make_product())
+    detail = OrderDetails.query.filter_by(order_id=order.id).one()
+    client.login(make_admin())
+
+    page = client.get(f"/admin/order/specific/{order.order_number}/{order.user_id}/").get_data(as_text=True)
+    assert re.search(r"<button[^>]*disabled>Ship</button>", page)
+    assert _ship(client, order, detail).status_code == 409
+    for status in ("Payment Pending", "Payment Failed"):
+        detail.order_status = status
+        db.session.commit()
+        assert _ship(client, order, detail).status_code == 409
+    db.session.expire_all()
+    assert OrderDetails.query.get(detail.id).order_status == "Payment Failed"
+
+
+def test_paid_lines_can_be_shipped(client, make_admin, make_user, make_product, make_order):
+    order = make_order(make_user(), make_product())
+    finalize_order(order.order_number, "succeeded")
+    db.session.commit()
+    detail = OrderDetails.query.filter_by(order_id=order.id).one()
+    client.login(make_admin())
+
+    assert _ship(client, order, detail).status_code == 302
+    db.session.expire_all()
+    assert OrderDetails.query.get(detail.id).order_status == "Shipped"
+    assert Orders.query.get(order.id).shipment_status == "Shipped"
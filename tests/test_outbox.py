@@ -0,0 +1,49 @@
+import threading
+import time
+
+from db_app import db, EmailOutbox
+from email_related_functions import email_worker, queue_email
+
+
+def test_a_row_is_claimed_once_until_its_claim_times_out():
+    for number in range(3):
+        queue_email(f"user{number}@example.com", "Hello", "Body")
+
+    assert len(email_worker.claim_due()) == 3
+    assert email_worker.claim_due() == []
+
+    email = EmailOutbox.query.first()
+    email.next_attempt_at = time.time() - 1  # its worker died
+    db.session.commit()
+    assert [row.id for row in email_worker.claim_due()] == [email.id]
+
+
+def test_retry_later_backs_off_then_gives_up():
+    queue_email("user@example.com", "Hello", "Body")
+    email = EmailOutbox.query.one()
+    attempts = []
+    while not email_worker.retry_later(email, OSError("refused")):
+        attempts.append((email.status, round(email.next_attempt_at - time.time())))
+    assert [status for status, _ in attempts] == ["pending"] * (email_worker.max_attempts - 1)
+    assert [wait for _, wait in attempts] == [email_worker.backoff_seconds * 2 ** n for n in range(len(attempts))]
+    assert (email.status, email.attempts, email.last_error) == ("failed", email_worker.max_attempts, "OSError: refused")
+
+
+def test_worker_runs_batches_until_stopped():
+    batches = []
+    stop = threading.Event()
+
+    def process_batch():
+        batches.append(1)
+        if len(batches) == 3:
+            stop.set()
+            raise RuntimeError("a failing batch does not stop the worker")
+        return 0
+
+    worker = threading.Thread(target=email_worker.run, args=(process_batch, stop))
+    worker.start()
+    deadline = time.monotonic() + 5
+    while worker.is_alive() and time.monotonic() < deadline:
+        email_worker.wake()
+        worker.join(timeout=0.05)
+    assert not worker.is_alive() and len(batches) == 3
@@ -0,0 +1,52 @@
+import pytest
+
+import main
+from db_app import db
+from product_related_functions import invalidate_catalog
+
+
+@pytest.fixture
+def renders(make_product, monkeypatch):
+    """How often the home page was rendered instead of served from the page cache"""
+    make_product(identifier="GATE-1")
+    calls = []
+
+    def counted(*args, **kwargs):
+        calls.append(args[0])
+        return product_listing(*args, **kwargs)
+    product_listing = main.product_listing
+    monkeypatch.setattr(main, "product_listing", counted)
+    return calls
+
+
+def test_a_page_the_browser_has_is_answered_with_304(client, renders):
+    etag = client.get("/").headers["ETag"]
+
+    response = client.get("/", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.data == b""
+    assert len(renders) == 1
+
+
+def test_logged_in_users_are_not_served_cached_pages(client, make_user, renders):
+    client.get("/")
+    client.login(make_user())
+
+    response = client.get("/")
+    client.get("/")
+
+    assert "ETag" not in response.headers
+    assert len(renders) == 3
+
+
+def test_cached_pages_are_dropped_when_the_catalog_changes(client, renders):
+    client.get("/")
+    client.get("/")
+    assert len(renders) == 1
+
+    invalidate_catalog()
+    db.session.commit()
+    client.get("/")
+
+    assert len(renders) == 2
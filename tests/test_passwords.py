@@ -0,0 +1,34 @@
+from threading import BoundedSemaphore
+
+from werkzeug.security import generate_password_hash
+
+import user_related_functions
+from db_app import db, User
+
+
+def test_login_rehashes_a_password_made_with_older_settings(app, client, make_user, monkeypatch):
+    monkeypatch.setitem(app.config, "PASSWORD_HASH_METHOD", "pbkdf2:sha256:2000")
+    user = make_user()
+    user.password = generate_password_hash("secret", "pbkdf2:sha256:1000", 8)
+    db.session.commit()
+
+    response = client.post("/login", data={"email": user.email, "password": "secret"})
+
+    assert response.status_code == 302
+    db.session.expire_all()
+    password = User.query.get(user.id).password
+    assert password.startswith("pbkdf2:sha256:2000$")
+    assert not user_related_functions.needs_rehash(password)
+
+
+def test_login_is_refused_with_503_while_the_password_pool_is_full(app, client, make_user, monkeypatch):
+    user = make_user()
+    slots = BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(user_related_functions, "_password_slots", slots)
+    monkeypatch.setitem(app.config, "PASSWORD_QUEUE_TIMEOUT", 0.01)
+
+    response = client.post("/login", data={"email": user.email, "password": "secret"})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
@@ -0,0 +1,219 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+import pytest
+import stripe
+
+import payment_related_functions
+from db_app import db, Orders, OrderDetails, Products, StripeEvents, User, TrackingInformation, UserAddresses
+from order_related_functions import STATUS_PAYMENT_FAILED, STATUS_PAYMENT_PENDING
+from payment_related_functions import queue_checkout, process_due_events, EVENT_MAX_ATTEMPTS
+
+
+def _queue_checkout(user, product, make_order):
+    order = make_order(user, product, quantity=2)
+    queue_checkout(order, "tok_visa", 3000)
+    db.session.commit()
+    return order
+
+
+def _unreachable_stripe(*args, **kwargs):
+    raise ConnectionError("stripe is down")
+
+
+def test_checkout_given_up_fails_the_order_and_returns_its_stock(make_user, make_product, make_order, monkeypatch):
+    product = make_product(stock=10)
+    order = _queue_checkout(make_user(), product, make_order)
+    assert Products.query.get(product.id).stock == 8
+    StripeEvents.query.update({StripeEvents.attempts: EVENT_MAX_ATTEMPTS - 1})
+    db.session.commit()
+    monkeypatch.setattr(payment_related_functions, "charge_user", _unreachable_stripe)
+
+    assert process_due_events() == 1
+
+    db.session.expire_all()
+    event = StripeEvents.query.one()
+    assert event.status == "failed"
+    assert "stripe is down" in event.last_error
+    assert Orders.query.get(order.id).payment_status == STATUS_PAYMENT_FAILED
+    details = OrderDetails.query.filter_by(order_id=order.id).all()
+    assert {detail.order_status for detail in details} == {STATUS_PAYMENT_FAILED}
+    assert Products.query.get(product.id).stock == 10
+    assert "token" not in json.loads(event.payload)["data"]["object"]
+
+
+def _fake_stripe(monkeypatch, charge_error=None):
+    calls = []
+
+    def create_customer(**kwargs):
+        calls.append(("customer", kwargs["idempotency_key"]))
+        return SimpleNamespace(id="cus_1")
+
+    def create_payment(**kwargs):
+        calls.append(("payment", kwargs["idempotency_key"]))
+        if charge_error is not None:
+            raise charge_error
+        return SimpleNamespace(id="pi_1", status="succeeded")
+
+    monkeypatch.setattr(stripe.Customer, "create", create_customer)
+    monkeypatch.setattr(stripe.PaymentIntent, "create", create_payment)
+    return calls
+
+
+def test_checkout_charges_settles_and_forgets_the_card_token(make_user, make_product, make_order, monkeypatch):
+    user = make_user()
+    order = _queue_checkout(user, make_product(stock=10), make_order)
+    calls = _fake_stripe(monkeypatch)
+
+    process_due_events()
+
+    db.session.expire_all()
+    event = StripeEvents.query.one()
+    assert event.status == "done"
+    assert "token" not in json.loads(event.payload)["data"]["object"]
+    assert [call[0] for call in calls] == ["customer", "payment"]
+    assert User.query.get(user.id).stripe_customer_id == "cus_1"
+    assert Orders.query.get(order.id).payment_status == "succeeded"
+    assert TrackingInformation.query.filter_by(order_number=order.order_number).count() == 1
+
+
+def test_failed_checkout_attempt_commits_nothing(make_user, make_product, make_order, monkeypatch):
+    user = make_user()
+    _queue_checkout(user, make_product(stock=10), make_order)
+    calls = _fake_stripe(monkeypatch, charge_error=ConnectionError("timeout"))
+
+    process_due_events()
+
+    db.session.expire_all()
+    event = StripeEvents.query.one()
+    assert event.status == "pending"
+    # the customer made before the charge failed is not saved on its own, the retry gets it again by its key
+    assert User.query.get(user.id).stripe_customer_id is None
+    assert json.loads(event.payload)["data"]["object"]["token"] == "tok_visa"
+    assert calls[0] == ("customer", f"order-{event.event_id.split('_')[1]}-customer")
+
+
+def test_checkout_retried_before_giving_up(make_user, make_product, make_order, monkeypatch):
+    product = make_product(stock=10)
+    order = _queue_checkout(make_user(), product, make_order)
+    monkeypatch.setattr(payment_related_functions, "charge_user", _unreachable_stripe)
+
+    process_due_events()
+
+    db.session.expire_all()
+    event = StripeEvents.query.one()
+    assert (event.status, event.attempts) == ("pending", 1)
+    assert json.loads(event.payload)["data"]["object"]["order_number"] == order.order_number
+    assert Orders.query.get(order.id).payment_status == "Payment Pending"
+    assert Products.query.get(product.id).stock == 8
+
+
+class _FakeStripe(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    objects = {"/v1/customers": {"id": "cus_fake", "object": "customer"},
+               "/v1/payment_intents": {"id": "pi_fake", "object": "payment_intent", "status": "succeeded"}}
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        self.server.calls.append((self.path, form))
+        body = json.dumps(self.objects[self.path]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_stripe(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeStripe)
+    server.daemon_threads = True
+    server.connections, server.calls = 0, []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(stripe, "api_base", f"http://127.0.0.1:{server.server_port}")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_checkouts_make_one_payment_call_over_one_connection(fake_stripe, make_user, make_product, make_order):
+    user = make_user()
+    product = make_product(stock=10)
+    for order_number in (1001, 1002):
+        queue_checkout(make_order(user, product, order_number=order_number), "tok_visa", 1500)
+    db.session.commit()
+
+    assert process_due_events() == 2
+
+    paths = [path for path, _ in fake_stripe.calls]
+    assert paths == ["/v1/customers", "/v1/payment_intents", "/v1/payment_intents"]
+    assert fake_stripe.connections == 1
+    payment = fake_stripe.calls[1][1]
+    assert payment["customer"] == ["cus_fake"]
+    assert payment["payment_method_data[card][token]"] == ["tok_visa"]
+    db.session.expire_all()
+    assert {order.payment_status for order in Orders.query.all()} == {"succeeded"}
+
+
+def test_a_charged_checkout_is_never_failed(make_user, make_product, make_order, monkeypatch):
+    product = make_product(stock=10)
+    order = _queue_checkout(make_user(), product, make_order)
+    calls = _fake_stripe(monkeypatch)
+
+    def settle_fails(order_number, payment_status):
+        raise AttributeError("'NoneType' object has no attribute 'name'")
+    monkeypatch.setattr(payment_related_functions, "finalize_order", settle_fails)
+    StripeEvents.query.update({StripeEvents.attempts: EVENT_MAX_ATTEMPTS - 2})
+    db.session.commit()
+
+    process_due_events()
+    StripeEvents.query.update({StripeEvents.next_attempt_at: 0})
+    db.session.commit()
+    process_due_events()
+
+    db.session.expire_all()
+    event = StripeEvents.query.one()
+    assert event.status == "failed"
+    assert json.loads(event.payload)["data"]["object"]["payment_id"] == "pi_1"
+    assert [call[0] for call in calls].count("payment") == 1  # the retry did not charge again
+    assert Orders.query.get(order.id).payment_status == STATUS_PAYMENT_PENDING
+    assert Products.query.get(product.id).stock == 8
+
+
+def test_the_address_of_an_unpaid_order_is_not_deleted(client, make_user, make_product, make_order):
+    user = make_user()
+    order = _queue_checkout(user, make_product(), make_order)
+    client.login(user)
+
+    client.get(f"/addresses/delete/{order.delivery_address_ids}/delivery/", headers={"Referer": "/"})
+    assert UserAddresses.query.get(order.delivery_address_ids) is not None
+
+    order.payment_status = "succeeded"
+    db.session.commit()
+    client.get(f"/addresses/delete/{order.delivery_address_ids}/delivery/", headers={"Referer": "/"})
+    db.session.expire_all()
+    assert UserAddresses.query.get(order.delivery_address_ids) is None
+
+
+def test_migration_drops_tokens_of_finished_checkouts(make_user, make_product, make_order):
+    from migrations import _forget_checkout_tokens
+
+    _queue_checkout(make_user(), make_product(), make_order)
+    StripeEvents.query.update({StripeEvents.status: "done"})
+    db.session.commit()
+
+    with db.engine.begin() as connection:
+        _forget_checkout_tokens(connection)
+
+    db.session.expire_all()
+    assert "token" not in json.loads(StripeEvents.query.one().payload)["data"]["object"]
@@ -0,0 +1,34 @@
+from sqlalchemy import text
+
+from db_app import db, cache_version
+from user_related_functions import get_principal, forget_principal
+
+
+def test_a_user_changed_in_another_process_is_seen_after_the_version_check(app, make_user, monkeypatch):
+    user = make_user()
+    monkeypatch.setitem(app.config, "PRINCIPAL_VERSION_CHECK_SECONDS", 3600)
+    assert get_principal(user.id).name == "Test"
+
+    # what forget_principal in another worker leaves behind: the committed row and a bumped version
+    with db.engine.begin() as connection:
+        connection.execute(text("UPDATE users SET name = 'Renamed'"))
+        connection.execute(text("DELETE FROM cache_versions WHERE name = 'principals'"))
+        connection.execute(text("INSERT INTO cache_versions (name, version) VALUES ('principals', 99)"))
+    db.session.expire_all()
+    assert get_principal(user.id).name == "Test"  # the version is not read again yet
+
+    monkeypatch.setitem(app.config, "PRINCIPAL_VERSION_CHECK_SECONDS", 0)
+    assert get_principal(user.id).name == "Renamed"
+
+
+def test_forget_principal_bumps_the_shared_version_with_the_change(make_user):
+    user = make_user()
+    assert get_principal(user.id).email == "user@example.com"
+    before = cache_version("principals")
+
+    user.email = "new@example.com"
+    forget_principal(user.id)
+    db.session.commit()
+
+    assert cache_version("principals") == before + 1
+    assert get_principal(user.id).email == "new@example.com"
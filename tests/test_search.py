@@ -0,0 +1,55 @@
+from db_app import app as flask_app, db
+from product_related_functions import index_product, invalidate_catalog, search_products
+
+
+def _indexed_products(make_product, count):
+    products = [make_product(identifier=f"GATE-{number}") for number in range(count)]
+    for product in products:
+        index_product(product)
+    invalidate_catalog()
+    db.session.commit()
+    return products
+
+
+def test_admin_search_pages_through_every_match(client, make_admin, make_product, monkeypatch):
+    monkeypatch.setitem(flask_app.config, "MAX_PAGE_SIZE", 4)
+    _indexed_products(make_product, 10)
+    client.login(make_admin())
+
+    seen, page, has_next = [], 1, True
+    while has_next:
+        response = client.get(f"/admin/inventory/search_by_title/?input_text=product&page={page}")
+        assert response.status_code == 200
+        seen += [f"GATE-{number}" for number in range(10) if f'value="GATE-{number}"'.encode() in response.data]
+        has_next = b"fa-chevron-right" in response.data
+        page += 1
+
+    assert sorted(seen) == sorted(f"GATE-{number}" for number in range(10))
+    assert page - 1 == 3  # 4 + 4 + 2
+
+
+def test_admin_search_needs_an_admin(client, make_user):
+    client.login(make_user())
+    assert client.post("/admin/inventory/search_by_title/", data={"input_text": "gate"}).status_code == 403
+
+
+def test_empty_searches_redirect(client, make_admin):
+    assert client.get("/search?search=").headers["Location"].endswith("/products")
+    assert client.get("/search?search=%20").headers["Location"].endswith("/products")
+    client.login(make_admin())
+    response = client.post("/admin/inventory/search_by_title/", data={"input_text": ""})
+    assert response.headers["Location"].endswith("/admin/inventory/filter/None")
+
+
+def test_search_offset_continues_where_the_limit_stopped(make_product):
+    _indexed_products(make_product, 6)
+    first, rest = search_products("product", limit=4), search_products("product", limit=4, offset=4)
+    assert len(first) == 4 and len(rest) == 2
+    assert not {product.id for product in first} & {product.id for product in rest}
+
+
+def test_punctuation_only_words_are_ignored(make_product):
+    _indexed_products(make_product, 2)
+
+    assert len(search_products("gate -")) == 2
+    assert search_products("- !") == []
@@ -0,0 +1,147 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+from db_app import app, db, Products, UserCart, Orders, OrderDetails, TrackingInformation
+from order_related_functions import reserve_stock, add_order_details, finalize_order
+
+BUYERS = 12
+STOCK = 5
+
+
+def _cart_line(user, product, quantity=1):
+    line = UserCart(product_id=product.id, product_identifier=product.product_identifier, title=product.title,
+                    color=product.color, price=product.price, quantity=quantity,
+                    total_price=product.price * quantity, main_img_path="x", user_id=user.id)
+    db.session.add(line)
+    db.session.commit()
+    return line
+
+
+def _all_at_once(func, count):
+    """Run func(i) in `count` threads released at the same moment"""
+    start = threading.Barrier(count)
+
+    def run(i):
+        start.wait()
+        with app.app_context():
+            return func(i)
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        return list(pool.map(run, range(count)))
+
+
+def test_parallel_reservations_of_the_last_units_never_oversell(make_user, make_product):
+    product = make_product(stock=STOCK)
+    users = [make_user(f"buyer{i}@example.com") for i in range(BUYERS)]
+    carts = [_cart_line(user, product).id for user in users]
+
+    results = _all_at_once(lambda i: reserve_stock([UserCart.query.get(carts[i])]) == [], BUYERS)
+
+    assert results.count(True) == STOCK
+    db.session.expire_all()
+    assert Products.query.get(product.id).stock == 0
+
+
+def test_parallel_checkouts_of_the_last_units_never_oversell(app, make_user, make_product):
+    product = make_product(stock=STOCK)
+    users = [make_user(f"buyer{i}@example.com") for i in range(BUYERS)]
+    for user in users:
+        _cart_line(user, product)
+    checkouts = [(user.id, user.user_address[0].id, user.user_billing_address[0].id) for user in users]
+
+    def checkout(i):
+        user_id, delivery_id, billing_id = checkouts[i]
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+        response = client.post(f"/checkout/order_now/{user_id}/15/", headers={"Referer": "/cart/"},
+                               data={"stripeToken": "tok_visa", "delivery_address": delivery_id,
+                                     "billing_address": billing_id})
+        return response.status_code
+
+    statuses = _all_at_once(checkout, BUYERS)
+
+    assert statuses.count(200) == STOCK  # charge.html
+    assert statuses.count(302) == BUYERS - STOCK  # back to the cart, out of stock
+    db.session.expire_all()
+    assert Products.query.get(product.id).stock == 0
+    assert Orders.query.count() == STOCK
+
+
+def test_a_cart_is_reserved_completely_or_not_at_all(make_user, make_product):
+    user = make_user()
+    plenty, scarce = make_product(stock=10, identifier="PLENTY"), make_product(stock=1, identifier="SCARCE")
+    lines = [_cart_line(user, plenty, 3), _cart_line(user, scarce, 2)]
+
+    failed = reserve_stock(lines)
+
+    assert [line.product_identifier for line in failed] == ["SCARCE"]
+    db.session.expire_all()
+    assert (Products.query.get(plenty.id).stock, Products.query.get(scarce.id).stock) == (10, 1)
+
+
+def test_one_conditional_update_per_cart_line(make_user, make_product):
+    user = make_user()
+    lines = [_cart_line(user, make_product(identifier=f"P{i}")) for i in range(4)]
+    updates = []
+
+    def count(conn, cursor, statement, *args):
+        if statement.startswith("UPDATE") and "cache_versions" not in statement:
+            updates.append(statement)
+    event.listen(db.engine, "before_cursor_execute", count)
+    try:
+        assert reserve_stock(lines) == []
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+
+    assert len(updates) == len(lines)
+    assert all("stock >=" in statement for statement in updates)
+
+
+def _statements(func, *args):
+    """Statements and commits func(*args) sends to the database"""
+    statements, commits = [], []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    def count_commit(conn):
+        commits.append(conn)
+    event.listen(db.engine, "before_cursor_execute", count)
+    event.listen(db.engine, "commit", count_commit)
+    try:
+        func(*args)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+        event.remove(db.engine, "commit", count_commit)
+    return len(statements), len(commits)
+
+
+def _place_and_settle(user, line_ids, order_number):
+    lines = UserCart.query.filter(UserCart.id.in_(line_ids)).all()
+    order = Orders(order_number=order_number, product_identifiers="", customer_name=user.name,
+                   customer_surname=user.surname, delivery_address_ids=user.user_address[0].id,
+                   billing_address_ids=user.user_billing_address[0].id, delivery_cost=0, total_order_value=0,
+                   order_date="01/01/2026 12:00:00", payment_status="Payment Pending",
+                   shipment_status="Payment Pending", user_id=user.id)
+    db.session.add(order)
+    placed = _statements(add_order_details, lines, order, user.id)
+    settled = _statements(lambda: (finalize_order(order_number, "succeeded"), db.session.commit()))
+    return placed, settled
+
+
+def test_orders_are_saved_and_settled_in_one_transaction_whatever_their_size(make_user, make_product):
+    user = make_user()
+    small = [_cart_line(user, make_product(identifier="SMALL")).id]
+    large = [_cart_line(user, make_product(identifier=f"LARGE-{i}")).id for i in range(20)]
+
+    small_placed, small_settled = _place_and_settle(user, small, 1)
+    large_placed, large_settled = _place_and_settle(user, large, 2)
+
+    assert large_placed[1] == large_settled[1] == 1  # one commit each
+    # the details and the tracking rows are one executemany each
+    assert (large_placed, large_settled) == (small_placed, small_settled)
+    tracking = TrackingInformation.query.filter_by(order_number=2).all()
+    assert len(tracking) == OrderDetails.query.filter_by(order_number=2).count() == 20
+    assert {row.delivery_address for row in tracking} == {"1 Test Street Testville TS 12345 Testland"}
@@ -0,0 +1,53 @@
+import io
+import os
+
+import pytest
+
+from image_related_functions import publish_uploads
+
+
+@pytest.fixture
+def staging(app, tmp_path, monkeypatch):
+    folder = tmp_path / "staging"
+    monkeypatch.setitem(app.config, "UPLOAD_STAGING_FOLDER", str(folder))
+    return folder
+
+
+def _upload(app, *names):
+    data = {"images": [(io.BytesIO(name.encode()), name) for name in names]}
+    return app.test_request_context("/admin/add", method="POST", data=data, content_type="multipart/form-data")
+
+
+def test_uploads_are_staged_and_moved_into_the_product_directory(app, staging, tmp_path):
+    product_dir = str(tmp_path / "images" / "metal" / "GATE-1")
+    with _upload(app, "main.jpg", "side.jpg") as context:
+        files = context.request.files.getlist("images")
+        assert len(os.listdir(staging)) == 2  # streamed to disk while the form was parsed
+
+        paths = publish_uploads(files, product_dir)
+
+    assert [os.path.basename(path).split("-", 5)[-1] for path in paths] == ["main.jpg", "side.jpg"]
+    assert [open(path, "rb").read() for path in paths] == [b"main.jpg", b"side.jpg"]
+    assert os.listdir(staging) == []
+
+
+def test_a_taken_product_directory_is_refused_and_its_uploads_removed(app, staging, tmp_path):
+    product_dir = tmp_path / "images" / "metal" / "GATE-1"
+    product_dir.mkdir(parents=True)
+    with _upload(app, "main.jpg") as context:
+        with pytest.raises(FileExistsError):
+            publish_uploads(context.request.files.getlist("images"), str(product_dir))
+
+    assert os.listdir(product_dir) == []
+    assert os.listdir(staging) == []  # removed when the request ended
+
+
+def test_parallel_uploads_keep_their_own_files(app, staging, tmp_path):
+    first, second = _upload(app, "a.jpg"), _upload(app, "b.jpg")
+    with first:
+        first_files = first.request.files.getlist("images")
+        with second:
+            second_paths = publish_uploads(second.request.files.getlist("images"), str(tmp_path / "second"))
+        first_paths = publish_uploads(first_files, str(tmp_path / "first"))
+
+    assert [open(path, "rb").read() for path in first_paths + second_paths] == [b"a.jpg", b"b.jpg"]
@@ -0,0 +1,152 @@
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock, BoundedSemaphore
+from time import monotonic
+
+from flask_login import UserMixin
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from db_app import app, db, User, AdminUser, bump_cache_version, cache_version
+from functions import process_pool
+
+# # # # # # # #  PRINCIPAL CACHE  # # # # # # # #
+# Identity and role of logged in users for current_user, kept PRINCIPAL_CACHE_TTL seconds. Dropped like the catalog
+# cache, when the "principals" row of cache_versions moves on (see forget_principal).
+_principal_lock = Lock()
+_principals = {}  # user id -> (loaded_at, principal)
+_PRINCIPAL_MAX_ENTRIES = 4096
+_principals_version = 0  # bumped by every forget, a principal loaded before one is not kept
+_shared_version = 0  # the shared version the cached principals were loaded at
+_version_checked_at = None  # monotonic() of the last read of the shared version
+
+
+class Principal(UserMixin):
+    """Read-only identity and role of the logged in user or admin"""
+    def __init__(self, id, name, surname, email, is_admin):
+        self.id = id
+        self.name = name
+        self.surname = surname
+        self.email = email
+        self.is_admin = is_admin
+
+
+def _load_principal(user_id):
+    # admins and users share the session id space, admin ids start above 1000
+    user = AdminUser.query.get(user_id) if user_id > 1000 else User.query.get(user_id)
+    if user is None:
+        return None
+    return Principal(user.id, user.name, user.surname, user.email, isinstance(user, AdminUser))
+
+
+def _sync_principals_version():
+    """Drop the cache if the shared principal version has changed since it was last read"""
+    global _principals_version, _shared_version, _version_checked_at
+    with _principal_lock:
+        now = monotonic()
+        if _version_checked_at is not None \
+                and now - _version_checked_at < app.config["PRINCIPAL_VERSION_CHECK_SECONDS"]:
+            return
+        _version_checked_at = now
+    version = cache_version("principals")
+    with _principal_lock:
+        if version != _shared_version:
+            _principals.clear()
+            _principals_version += 1
+            _shared_version = version
+
+
+def get_principal(user_id):
+    """Cached principal of a user or admin id, None if there is no such account"""
+    user_id = int(user_id)
+    _sync_principals_version()
+    with _principal_lock:
+        entry = _principals.get(user_id)
+        if entry is not None and monotonic() - entry[0] <= app.config["PRINCIPAL_CACHE_TTL"]:
+            return entry[1]
+        version = _principals_version
+    principal = _load_principal(user_id)
+    with _principal_lock:
+        # not kept if a user was changed while it loaded, it may be the old row
+        if principal is not None and version == _principals_version:
+            if len(_principals) >= _PRINCIPAL_MAX_ENTRIES:
+                _principals.clear()
+            _principals[user_id] = (monotonic(), principal)
+    return principal
+
+
+def forget_principal(user_id):
+    """Call in the transaction that changes a user's name, email or password, before its commit. Every process
+    loads the user again within PRINCIPAL_VERSION_CHECK_SECONDS."""
+    global _principals_version, _version_checked_at
+    bump_cache_version("principals")
+    with _principal_lock:
+        _principals.pop(int(user_id), None)
+        _principals_version += 1
+        _version_checked_at = None
+
+
+# # # # # # # #  PASSWORDS  # # # # # # # #
+# pbkdf2 takes a few hundred ms of cpu per hash. Hashing and checking run in a small process pool, so a burst
+# of logins can't take every request thread of a worker, and at most PASSWORD_MAX_PENDING of them wait for it.
+# Past that a login is answered with 503 and Retry-After instead of queueing without limit.
+_password_pool = None
+_password_slots = None
+_password_pool_lock = Lock()
+
+
+class PasswordHashingBusy(Exception):
+    """Too many password checks are waiting for the pool"""
+
+
+def _run_password_job(func, *args):
+    global _password_pool, _password_slots
+    with _password_pool_lock:
+        if _password_slots is None:
+            _password_slots = BoundedSemaphore(app.config['PASSWORD_MAX_PENDING'])
+        if _password_pool is None and app.config['PASSWORD_WORKERS'] > 0:
+            _password_pool = process_pool(app.config['PASSWORD_WORKERS'])
+        pool = _password_pool
+    if not _password_slots.acquire(timeout=app.config['PASSWORD_QUEUE_TIMEOUT']):
+        raise PasswordHashingBusy()
+    try:
+        if pool is None:
+            return func(*args)
+        return pool.submit(func, *args).result()
+    except BrokenProcessPool:
+        with _password_pool_lock:
+            if _password_pool is pool:
+                _password_pool = None  # a worker died, the next job starts a new pool
+        raise
+    finally:
+        _password_slots.release()
+
+
+def hash_password(password):
+    return _run_password_job(generate_password_hash, password,
+                             app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'])
+
+
+def verify_password(password_hash, password):
+    return _run_password_job(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """True if the hash was made with an older method, iteration count or a shorter salt"""
+    method, _, rest = password_hash.partition("$")
+    salt = rest.partition("$")[0]
+    return method != app.config['PASSWORD_HASH_METHOD'] or len(salt) < app.config['PASSWORD_SALT_LENGTH']
+
+
+def check_login(account, password):
+    """Check the password of a User / AdminUser row. A correct password that was hashed with older settings is
+    hashed again and saved."""
+    if not verify_password(account.password, password):
+        return False
+    if needs_rehash(account.password):
+        account.password = hash_password(password)
+        db.session.commit()
+    return True
+
+
+@app.errorhandler(PasswordHashingBusy)
+def _password_hashing_busy(error):
+    return "Too many sign-ins at the moment, please try again in a few seconds.", 503, {"Retry-After": "5"}
@@ -0,0 +1,30 @@
+"""Production entry point, one app per worker process:
+    python static_assets.py build          # once per deploy
+    flask --app wsgi create-schema         # once per deploy
+    gunicorn --workers 4 --bind 0.0.0.0:8000 wsgi:app
+`python wsgi.py` checks the startup time against STARTUP_BUDGET_MS.
+"""
+import time
+
+_started = time.perf_counter()
+
+import logging  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+
+from dotenv import load_dotenv  # noqa: E402
+
+load_dotenv()
+
+from main import create_app  # noqa: E402
+
+STARTUP_BUDGET_MS = int(os.getenv("STARTUP_BUDGET_MS", 1500))
+
+app = create_app()
+startup_ms = (time.perf_counter() - _started) * 1000
+if startup_ms > STARTUP_BUDGET_MS:
+    logging.warning(f"App startup took {startup_ms:.0f} ms, budget is {STARTUP_BUDGET_MS} ms")
+
+if __name__ == "__main__":
+    print(f"startup: {startup_ms:.0f} ms (budget {STARTUP_BUDGET_MS} ms)")
+    sys.exit(1 if startup_ms > STARTUP_BUDGET_MS else 0)